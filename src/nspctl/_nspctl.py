@@ -1,35 +1,139 @@
 import errno
+import fnmatch
 import logging
 import os
 import re
 import functools
 import shutil
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .utils.systemd import systemd_version
-from .utils.cmd import run_cmd, popen
+from .utils.host import host_systemd_version, host_roots, host_tool
+from .utils.cmd import run_cmd, popen, stream_cmd
 from .utils.args import invalid_kwargs, clean_kwargs
-from .utils.container_resource import cont_run, cont_cpt, con_init, login_shell
-from .utils.path import which
+from .utils.container_resource import (
+    cont_run, cont_stream, cont_cpt, cont_cpt_tree, cont_cpf, cont_sync, con_init, login_shell,
+    human_size,
+)
+from .utils.nsexec import cmd_argv, container_env, setns_available
+from .utils.agent import attach, detach, get_agent
 from .lib.functools import alias_function
 from .utils.user import get_uid
 from .utils.platform import get_arch
-from .utils.getfile import file_get
+from .utils.getfile import SEGMENTS, file_get
+from .utils.cache import ArtifactCache, parse_size
 from .utils.tar import tar_extract
-from .utils.checksum import checksum_url, parse_checksum, verify_all
+from .utils.checksum import checksum_url, parse_checksum
+from .utils import machined
+from .utils.inventory import Inventory, MetaCache, image_exists, lookup
 
 logger = logging.getLogger(__name__)
 
 __virtualname__ = "nspawn"
 WANT = "/etc/systemd/system/multi-user.target.wants/systemd-nspawn@{0}.service"
-EXEC_DRIVER = "nsenter"
+EXEC_DRIVER = "setns" if setns_available() else "nsenter"
+BULK_ACTIONS = ("start", "stop", "poweroff", "terminate", "reboot", "enable", "disable")
+
+# per thread state: the inventory snapshot and metadata cache shared by
+# nested calls
+_local = threading.local()
+# metadata cache shared across calls, only used when a ttl is set
+_shared_cache = MetaCache()
 
 
 def _sd_version():
     """
     Returns systemd version
     """
-    return systemd_version()
+    return host_systemd_version()
+
+
+def _inventory():
+    """
+    Return the inventory snapshot, collected once per outermost call
+    """
+    inv = getattr(_local, "inventory", None)
+    if inv is None:
+        inv = Inventory.collect()
+        if getattr(_local, "depth", 0):
+            _local.inventory = inv
+    return inv
+
+
+def _metacache():
+    """
+    Return the metadata cache of the current call, or the shared one when
+    a cache ttl is set
+    """
+    if _shared_cache.ttl is not None:
+        return _shared_cache
+    cache = getattr(_local, "cache", None)
+    if cache is None:
+        cache = MetaCache()
+        if getattr(_local, "depth", 0):
+            _local.cache = cache
+    return cache
+
+
+def set_cache_ttl(ttl=None):
+    """
+    Keep container metadata for ttl seconds across calls. Meant for
+    long running library users; None limits the cache to a single call.
+    """
+    _shared_cache.ttl = ttl
+    _shared_cache.invalidate()
+
+
+def invalidate(name=None):
+    """
+    Forget cached metadata of a container, or of all containers
+    """
+    _local.inventory = None
+    cache = getattr(_local, "cache", None)
+    if cache is not None:
+        cache.invalidate(name)
+    _shared_cache.invalidate(name)
+    detach(name)
+
+
+def _machine_status(name):
+    """
+    Return (state, leader PID) of a container, from the current snapshot
+    if there is one, otherwise from a direct lookup
+    """
+    cache = _metacache()
+    ret = cache.get(name, "status")
+    if ret is not MetaCache.MISS:
+        return ret
+    inv = getattr(_local, "inventory", None)
+    if inv is not None and name in inv:
+        image = inv.get(name)
+        ret = image.state, image.leader
+    else:
+        ret = lookup(name)
+    return cache.set(name, "status", ret)
+
+
+def _snapshot_scope(wrapped):
+    """
+    Decorator to share one inventory snapshot and metadata cache across
+    nested calls
+    """
+
+    @functools.wraps(wrapped)
+    def scoped(*args, **kwargs):
+        _local.depth = getattr(_local, "depth", 0) + 1
+        try:
+            return wrapped(*args, **kwargs)
+        finally:
+            _local.depth -= 1
+            if not _local.depth:
+                _local.inventory = None
+                _local.cache = None
+
+    return scoped
 
 
 def _ensure_exists(wrapped):
@@ -37,6 +141,7 @@ def _ensure_exists(wrapped):
     Decorator to ensure that the named container exists
     """
 
+    @_snapshot_scope
     @functools.wraps(wrapped)
     def check_exits(name, *args, **kwargs):
         if not exists(name):
@@ -64,20 +169,11 @@ def _root(name="", all_roots=False):
     Return the container root directory. Starting with systemd 219, new
     images go into /var/lib/machines.
     """
-    if _sd_version() >= 219:
-        if all_roots:
-            return [
-                os.path.join(x, name)
-                for x in ("/var/lib/machines", "/var/lib/container")
-            ]
-        else:
-            return os.path.join("/var/lib/machines", name)
+    roots = host_roots()
+    if all_roots:
+        return [os.path.join(x, name) for x in roots]
     else:
-        ret = os.path.join("/var/lib/container", name)
-        if all_roots:
-            return [ret]
-        else:
-            return ret
+        return os.path.join(roots[0], name)
 
 
 def _make_container_root(name):
@@ -115,7 +211,7 @@ def _bootstrap_arch(name, **kwargs):
     """
     Bootstrap an Arch Linux container
     """
-    if not which("pacstrap"):
+    if not host_tool("pacstrap"):
         raise Exception(
             "pacstrap not found, is the arch-install-scripts package installed?"
         )
@@ -179,37 +275,39 @@ def _bootstrap_alpine(name, **kwargs):
             raise Exception("Rootfs version not found")
 
         rootfs_url = base_url + rootfs_version
-        # get checksum url for data integrity
+        # get the checksum first, the rootfs is verified while it downloads
         sums_url = checksum_url(rootfs_version, "SHA256")
-        fetch_rootfs = file_get(rootfs_url, temp_dir)
-        if fetch_rootfs == 0:
-            for file in sums_url:
-                new_url = base_url + file
-                conn = file_get(new_url, temp_dir)
-                if conn == 0:
-                    sum_file = file
-            my_dict = {}
-            chksum = parse_checksum(rootfs_version, os.path.join(temp_dir, sum_file))
-            my_dict.update({"SHA256": chksum})
-            temp_path = os.path.join(temp_dir, rootfs_version)
-            # verify file checksum
-            verify = verify_all(temp_path, my_dict)
-            if verify[0] is True:
-                tar_extract(temp_path, dest)
-                init_path = os.path.join(dest, "etc/inittab")
-                if os.path.exists(init_path):
-                    temp_init = tempfile.mkstemp(dir=temp_dir)
-                    temp = open(temp_init[1], "w")
-                    with open(init_path, "r") as f:
-                        inittab = f.read()
-                    # comment out the tty[0-9] lines in the inittab file
-                    new_inittab = re.sub("(^tty[0-9])", r"#\1", inittab, flags=re.M)
-                    temp.write(new_inittab)
-                    temp.close()
-                    shutil.move(temp_init[1], init_path)
-                    return True
-            else:
-                raise Exception("'{}': The checksum format is invalid".format(rootfs_version))
+        sum_file = None
+        for file in sums_url:
+            new_url = base_url + file
+            if file_get(new_url, temp_dir) == 0:
+                sum_file = file
+                break
+        if sum_file is None:
+            raise Exception("'{}': Checksum file not found".format(rootfs_version))
+        my_dict = {}
+        chksum = parse_checksum(rootfs_version, os.path.join(temp_dir, sum_file))
+        my_dict.update({"SHA256": chksum})
+        # a bootstrap of the same release is served from the local cache
+        fetch_rootfs = ArtifactCache().fetch(
+            rootfs_url, temp_dir, digests=my_dict, segments=SEGMENTS
+        )
+        if fetch_rootfs != 0:
+            raise Exception("'{}': Download or checksum verification failed".format(rootfs_version))
+        temp_path = os.path.join(temp_dir, rootfs_version)
+        tar_extract(temp_path, dest)
+        init_path = os.path.join(dest, "etc/inittab")
+        if os.path.exists(init_path):
+            temp_init = tempfile.mkstemp(dir=temp_dir)
+            temp = open(temp_init[1], "w")
+            with open(init_path, "r") as f:
+                inittab = f.read()
+            # comment out the tty[0-9] lines in the inittab file
+            new_inittab = re.sub("(^tty[0-9])", r"#\1", inittab, flags=re.M)
+            temp.write(new_inittab)
+            temp.close()
+            shutil.move(temp_init[1], init_path)
+            return True
     except Exception as exc:
         _build_failed(dest, name)
         raise Exception(str(exc)) from None
@@ -223,7 +321,7 @@ def _bootstrap_debian(name, **kwargs):
     """
     Bootstrap a Debian Linux container
     """
-    if not which("debootstrap"):
+    if not host_tool("debootstrap"):
         raise Exception(
             "debootstrap not found, is the debootstrap package installed?"
         )
@@ -257,7 +355,7 @@ def _bootstrap_ubuntu(name, **kwargs):
     """
     Bootstrap a Ubuntu Linux container
     """
-    if not which("debootstrap"):
+    if not host_tool("debootstrap"):
         raise Exception(
             "debootstrap not found, is the debootstrap package installed?"
         )
@@ -302,9 +400,13 @@ def bootstrap_container(name, dist=None, version=None):
             'Unsupported distribution "{}"'.format(dist)
         )
     try:
-        return globals()["_bootstrap_{}".format(dist)](name, version=version)
+        func = globals()["_bootstrap_{}".format(dist)]
     except KeyError:
         raise Exception('Unsupported distribution "{}"'.format(dist))
+    try:
+        return func(name, version=version)
+    finally:
+        invalidate(name)
 
 
 bootstrap = alias_function(bootstrap_container, "bootstrap")
@@ -350,7 +452,12 @@ def _ensure_consystemd(name):
     """
     orig_state = state(name)
     pid = con_pid(name)
-    return con_init(
+    cache = _metacache()
+    ret = cache.get(name, "init")
+    # a new leader may run another init system
+    if ret is not MetaCache.MISS and ret[0] == pid:
+        return ret[1]
+    is_systemd = con_init(
         pid,
         state=orig_state,
         container_type=__virtualname__,
@@ -358,45 +465,25 @@ def _ensure_consystemd(name):
         is_shell=True,
         keep_env=True,
     )
+    inv = getattr(_local, "inventory", None)
+    if inv is not None and name in inv:
+        inv.get(name).init = is_systemd
+    cache.set(name, "init", (pid, is_systemd))
+    return is_systemd
 
 
 def list_all():
     """
     Lists all nspawn containers
     """
-    ret = []
-    con_all = _machinectl("list-images")["stdout"]
-    if _sd_version() >= 219 and con_all is not None:
-        for line in con_all.splitlines():
-            try:
-                ret.append(line.split()[0])
-            except IndexError:
-                continue
-    else:
-        rootdir = _root()
-        try:
-            for dirname in os.listdir(rootdir):
-                if os.path.isdir(os.path.join(rootdir, dirname)):
-                    ret.append(dirname)
-        except OSError:
-            pass
-    return ret
+    return _inventory().names()
 
 
 def list_running():
     """
     Lists running nspawn containers
     """
-    ret = []
-    con_running = _machinectl("list")["stdout"]
-    if con_running is not None:
-        for line in con_running.splitlines():
-            try:
-                ret.append(line.split()[0])
-            except IndexError:
-                pass
-
-    return ret
+    return _inventory().running()
 
 
 # 'machinectl list' shows only running containers, so allow this to work as an
@@ -408,42 +495,50 @@ def list_stopped():
     """
     Lists stopped nspawn containers
     """
-    return sorted(set(list_all()) - set(list_running()))
+    return _inventory().stopped()
 
 
 def exists(name):
     """
     Return true if the named container exists
     """
-    if name in list_all():
-        return True
-    else:
-        return False
+    cache = _metacache()
+    found = cache.get(name, "exists")
+    if found is not MetaCache.MISS:
+        return found
+    found = None
+    if getattr(_local, "inventory", None) is None and _sd_version() >= 219:
+        found = image_exists(name)
+    if found is None:
+        found = name in _inventory()
+    return cache.set(name, "exists", found)
 
 
-def _machinectl(cmd):
+def _machine_action(action, name, *args):
     """
-    Helper function to run machinectl
+    Run a machinectl verb through machined over D-Bus, falling back to
+    the machinectl command
     """
-    prefix = "machinectl --no-legend --no-pager"
-    return run_cmd("{} {}".format(prefix, cmd), is_shell=True)
+    ret = machined.machine_action(action, name, *args)
+    if ret is None:
+        ret = machined.machinectl(" ".join((action, name) + args))
+    return ret
 
 
 @_ensure_exists
-def _run(
+def _cont_run(
     name,
     cmd,
     is_shell=None,
-    output=None,
     preserve_state=False,
     keep_env=None,
+    capture=None,
 ):
     """
-    Common logic for run functions
+    Run a command through the exec driver
     """
     orig_state = state(name)
     pid = con_pid(name)
-    exc = None
     try:
         ret = cont_run(
             pid,
@@ -451,13 +546,64 @@ def _run(
             container_type=__virtualname__,
             exec_driver=EXEC_DRIVER,
             is_shell=is_shell,
-            keep_env=keep_env
+            keep_env=keep_env,
+            capture=capture,
         )
     finally:
         # Make sure we stop the container if necessary, even if an exception
         # was raised.
         if preserve_state and orig_state == "stopped" and state(name) != "stopped":
             stop(name)
+    return ret
+
+
+@_snapshot_scope
+def _agent_run(name, cmd, is_shell=None, keep_env=None):
+    """
+    Run a command through the exec agent of a running container, which
+    is attached on first use. None if the container is not running or
+    the agent is gone, the caller then uses the exec driver.
+    """
+    if EXEC_DRIVER != "setns":
+        return None
+    agent = get_agent(name)
+    if agent is None:
+        if not exists(name) or _machine_status(name)[0] != "running":
+            return None
+        try:
+            agent = attach(name, con_pid(name))
+        except OSError as exc:
+            logger.debug("Unable to attach exec agent to %s: %s", name, exc)
+            return None
+    return agent.run(cmd_argv(cmd, is_shell), container_env(keep_env))
+
+
+def _run(
+    name,
+    cmd,
+    is_shell=None,
+    output=None,
+    preserve_state=False,
+    keep_env=None,
+    agent=False,
+    capture=None,
+):
+    """
+    Common logic for run functions
+    """
+    ret = None
+    # the agent sends whole outputs back, it has no capture policy
+    if agent and capture is None:
+        ret = _agent_run(name, cmd, is_shell=is_shell, keep_env=keep_env)
+    if ret is None:
+        ret = _cont_run(
+            name,
+            cmd,
+            is_shell=is_shell,
+            preserve_state=preserve_state,
+            keep_env=keep_env,
+            capture=capture,
+        )
 
     c_output = {"stdout": "stdout", "stderr": "stderr", "returncode": "returncode"}
     if output is not None:
@@ -472,10 +618,15 @@ def con_pid(name):
     """
     Returns the PID of a container
     """
+    leader = _machine_status(name)[1]
+    if leader is None:
+        # a stopped container has no PID, start it like info() does
+        _ensure_running(name)
+        leader = _machine_status(name)[1]
     try:
-        return int(info(name).get("PID"))
+        return int(leader)
     except (TypeError, ValueError) as exc:
-        raise exc(
+        raise Exception(
             "Unable to get PID for container '{}': {}".format(name, exc)
         )
 
@@ -486,9 +637,14 @@ def run(
     is_shell=True,
     preserve_state=True,
     keep_env=None,
+    agent=False,
+    capture=None,
 ):
     """
-    Run command within a container
+    Run command within a container. With agent=True the command goes
+    through a helper kept attached to the container, for callers running
+    many commands. capture is a utils.cmd.Capture policy for commands
+    with large output.
     """
     return _run(
         name,
@@ -496,6 +652,8 @@ def run(
         is_shell=is_shell,
         preserve_state=preserve_state,
         keep_env=keep_env,
+        agent=agent,
+        capture=capture,
     )
 
 
@@ -505,6 +663,8 @@ def run_stdout(
     is_shell=True,
     preserve_state=True,
     keep_env=None,
+    agent=False,
+    capture=None,
 ):
     """
     Run command within a container and response output stdout
@@ -516,6 +676,8 @@ def run_stdout(
         is_shell=is_shell,
         preserve_state=preserve_state,
         keep_env=keep_env,
+        agent=agent,
+        capture=capture,
     )
 
 
@@ -525,6 +687,8 @@ def run_stderr(
     is_shell=True,
     preserve_state=True,
     keep_env=None,
+    agent=False,
+    capture=None,
 ):
     """
     Run command within a container and response output stderr
@@ -536,6 +700,8 @@ def run_stderr(
         is_shell=is_shell,
         preserve_state=preserve_state,
         keep_env=keep_env,
+        agent=agent,
+        capture=capture,
     )
 
 
@@ -545,6 +711,7 @@ def retcode(
     is_shell=True,
     preserve_state=True,
     keep_env=None,
+    agent=False,
 ):
     """
     Run command within a container and response returncode
@@ -556,40 +723,47 @@ def retcode(
         is_shell=is_shell,
         preserve_state=preserve_state,
         keep_env=keep_env,
+        agent=agent,
     )
 
 
 @_ensure_exists
-def state(name):
+def run_stream(
+    name,
+    cmd,
+    is_shell=True,
+    keep_env=None,
+    lines=True,
+):
     """
-    Return state of container (running or stopped)
+    Run command within a container and stream its output. Returns a
+    utils.cmd.Stream yielding ("stdout" or "stderr", line) as it arrives,
+    or raw chunks with lines=False; its returncode is set at the end.
     """
-    try:
-        cmd = "show {} --property=State".format(name)
-        return _machinectl(cmd)["stdout"].split("=")[-1]
-    except AttributeError:
-        return "stopped"
+    _ensure_running(name)
+    return cont_stream(
+        con_pid(name),
+        cmd,
+        container_type=__virtualname__,
+        exec_driver=EXEC_DRIVER,
+        is_shell=is_shell,
+        keep_env=keep_env,
+        lines=lines,
+    )
 
 
-def info(name, **kwargs):
+@_ensure_exists
+def state(name):
     """
-    Return info about a container
+    Return state of container (running or stopped)
     """
-    kwargs = clean_kwargs(**kwargs)
-    start_ = kwargs.pop("start", False)
-    if kwargs:
-        invalid_kwargs(kwargs)
+    return _machine_status(name)[0]
 
-    if not start_:
-        _ensure_running(name)
-    elif name not in list_running():
-        start(name)
 
-    # Have to parse 'machinectl status' here since 'machinectl show' doesn't
-    # contain IP address info or OS info. *shakes fist angrily*
-    c_info = _machinectl("status {}".format(name))
-    if c_info["returncode"] != 0:
-        return "Unable to get info for container '{}'".format(name)
+def _parse_status(stdout):
+    """
+    Parse 'machinectl status' output into a dict
+    """
     # Better human-readable names. False means key should be ignored.
     key_name_map = {
         "Iface": "Network Interface",
@@ -600,7 +774,7 @@ def info(name, **kwargs):
     ret = {}
     kv_pair = re.compile(r"^\s+([A-Za-z]+): (.+)$")
     tree = re.compile(r"[|`]")
-    lines = c_info["stdout"].splitlines()
+    lines = (stdout or "").splitlines()
     multiline = False
     cur_key = None
     for idx, line in enumerate(lines):
@@ -634,6 +808,55 @@ def info(name, **kwargs):
     return ret
 
 
+@_snapshot_scope
+def info(name=None, all_images=False, **kwargs):
+    """
+    Return info about a container
+    """
+    kwargs = clean_kwargs(**kwargs)
+    start_ = kwargs.pop("start", False)
+    if kwargs:
+        invalid_kwargs(kwargs)
+
+    if all_images:
+        return info_all()
+    if name is None:
+        raise Exception("Container name or --all is required")
+
+    if not start_:
+        _ensure_running(name)
+    elif name not in list_running():
+        start(name)
+
+    inv = _inventory()
+    inv.fill([name])
+    image = inv.get(name)
+    if image is not None and inv.source != "machinectl" and machined.get_bus():
+        ret = image.as_dict()
+        os_release = machined.machine_os_release(name)
+        if os_release.get("PRETTY_NAME"):
+            ret["OS"] = os_release["PRETTY_NAME"]
+        return ret
+
+    # Have to parse 'machinectl status' here since 'machinectl show' doesn't
+    # contain IP address info or OS info. *shakes fist angrily*
+    c_info = machined.machinectl("status {}".format(name))
+    if c_info["returncode"] != 0:
+        if image is not None and inv.source == "fs":
+            return image.as_dict()
+        return "Unable to get info for container '{}'".format(name)
+    return _parse_status(c_info["stdout"])
+
+
+def info_all():
+    """
+    Return info about all containers from a single inventory snapshot
+    """
+    inv = _inventory()
+    inv.fill()
+    return inv.as_dict()
+
+
 @_ensure_exists
 @_check_useruid
 def start(name):
@@ -641,10 +864,11 @@ def start(name):
     Start the named container
     """
     if _sd_version() >= 219:
-        ret = _machinectl("start {}".format(name))
+        ret = _machine_action("start", name)
     else:
         cmd = "systemctl start systemd-nspawn@{}".format(name)
         ret = run_cmd(cmd, is_shell=True)
+    invalidate(name)
 
     if ret["returncode"] != 0:
         return False
@@ -664,7 +888,7 @@ def stop(name, kill=False):
             action = "terminate"
         else:
             action = "poweroff"
-        ret = _machinectl("{} {}".format(action, name))
+        ret = _machine_action(action, name)
     else:
         # systemd-nspawn does not stop another init system.
         # or "systemctl stop" command gives timeout.
@@ -672,6 +896,7 @@ def stop(name, kill=False):
         # if we execute "poweroff -f", exit status 137
         cmd = "poweroff"
         ret = run(name, cmd)
+    invalidate(name)
 
     # command exit codes:
     # terminate -> 143, kill -> 137
@@ -729,10 +954,11 @@ def reboot(name):
     """
     if state(name) == "running":
         if _ensure_consystemd(name):
-            ret = _machinectl("reboot {}".format(name))
+            ret = _machine_action("reboot", name)
         else:
             cmd = "reboot"
             ret = run(name, cmd)
+        invalidate(name)
     else:
         return start(name)
 
@@ -744,6 +970,77 @@ def reboot(name):
     return True
 
 
+def select(names=None, selector=None):
+    """
+    Resolve container names, glob patterns and the all, running or
+    stopped selectors into a list of container names
+    """
+    selectors = {
+        "all": list_all,
+        "running": list_running,
+        "stopped": list_stopped,
+    }
+    if selector is not None and selector not in selectors:
+        raise Exception("Invalid selector '{}'".format(selector))
+
+    ret = []
+    if selector is not None:
+        ret.extend(selectors[selector]())
+    if names:
+        if isinstance(names, str):
+            names = [names]
+        known = None
+        for name in names:
+            if any(x in name for x in "*?["):
+                if known is None:
+                    known = list_all()
+                ret.extend(fnmatch.filter(known, name))
+            else:
+                ret.append(name)
+    # keep the order, drop duplicates
+    return list(dict.fromkeys(ret))
+
+
+@_check_useruid
+def bulk(action, names=None, selector=None, parallel=1):
+    """
+    Run a lifecycle action on many containers, at most parallel at a
+    time. Returns the result and duration per container.
+    """
+    if action not in BULK_ACTIONS:
+        raise Exception("Unsupported bulk action '{}'".format(action))
+    targets = select(names, selector)
+    if not targets:
+        raise Exception("No container matches the given names")
+    func = globals()[action]
+
+    def _one(name):
+        begin = time.monotonic()
+        error = None
+        try:
+            ok = func(name) is True
+        except Exception as exc:
+            ok = False
+            error = str(exc)
+        ret = {
+            "result": "ok" if ok else "failed",
+            "time": "{:.2f}s".format(time.monotonic() - begin),
+        }
+        if error:
+            ret["error"] = error
+        return ret
+
+    with ThreadPoolExecutor(max_workers=max(1, int(parallel))) as pool:
+        return dict(zip(targets, pool.map(_one, targets)))
+
+
+def bulk_failed(results):
+    """
+    Return the names that failed in bulk() results
+    """
+    return [x for x, y in results.items() if y["result"] != "ok"]
+
+
 @_ensure_exists
 @_check_useruid
 def remove(name, stop=False):
@@ -757,7 +1054,7 @@ def remove(name, stop=False):
         raise Exception("Unable to remove container '{}': '{}'".format(name, exc))
 
     if _sd_version() >= 219:
-        ret = _machinectl("remove {}".format(name))
+        ret = _machine_action("remove", name)
         if ret["returncode"] != 0:
             _failed_remove(name, ret["stderr"])
     else:
@@ -765,18 +1062,39 @@ def remove(name, stop=False):
             shutil.rmtree(os.path.join(_root(), name))
         except OSError as exc:
             _failed_remove(name, exc)
+    invalidate(name)
 
     return True
 
 
 @_ensure_exists
 @_check_useruid
-def copy_to(name, source, dest, overwrite=False, makedirs=False):
+def copy_to(name, source, dest, overwrite=False, makedirs=False, progress=None):
     """
-    Copy a file from host in to a container
+    Copy a file from host in to a container. source may also be a
+    directory or a list of files and directories, which are streamed into
+    the dest directory as one tar archive. progress(done, total, elapsed)
+    is called while the archive is sent.
     """
+    sources = [source] if isinstance(source, str) else list(source)
+    if len(sources) != 1 or not os.path.isfile(sources[0]):
+        orig_state = state(name)
+        pid = con_pid(name)
+        return cont_cpt_tree(
+            pid,
+            sources,
+            dest,
+            state=orig_state,
+            container_type=__virtualname__,
+            exec_driver=EXEC_DRIVER,
+            overwrite=overwrite,
+            makedirs=makedirs,
+            progress=progress,
+        )
+    source = sources[0]
+
     if _ensure_consystemd(name):
-        ret = _machinectl("copy-to {} {} '{}'".format(name, source, dest))
+        ret = machined.machinectl("copy-to {} {} '{}'".format(name, source, dest))
         if ret["returncode"] != 0:
             raise Exception("Failed to copying file/s")
         else:
@@ -797,6 +1115,60 @@ def copy_to(name, source, dest, overwrite=False, makedirs=False):
         return ret
 
 
+@_ensure_exists
+@_check_useruid
+def copy_from(name, source, dest, overwrite=False, compress=None, progress=None):
+    """
+    Copy a file or directory tree from a container to the host. With
+    compress ("gz", "bz2" or "xz") dest is written as a compressed tar
+    archive. progress(done, total, elapsed) is called during the copy.
+    """
+    if compress is None and _ensure_consystemd(name):
+        ret = machined.machinectl("copy-from {} '{}' '{}'".format(name, source, dest))
+        if ret["returncode"] != 0:
+            raise Exception("Failed to copying file/s")
+        else:
+            return ret
+    else:
+        orig_state = state(name)
+        pid = con_pid(name)
+        return cont_cpf(
+            pid,
+            source,
+            dest,
+            state=orig_state,
+            container_type=__virtualname__,
+            exec_driver=EXEC_DRIVER,
+            overwrite=overwrite,
+            compress=compress,
+            progress=progress,
+        )
+
+
+@_ensure_exists
+@_check_useruid
+def sync(name, source, dest, checksum=None, delete=False, progress=None):
+    """
+    Update the dest directory of a container from the host directory
+    source, transferring only new and changed files. Files are compared
+    by size and mtime, or by content with checksum ("MD5", "SHA1",
+    "SHA256" or "SHA512"). delete removes files missing on the host.
+    """
+    orig_state = state(name)
+    pid = con_pid(name)
+    return cont_sync(
+        pid,
+        source,
+        dest,
+        state=orig_state,
+        container_type=__virtualname__,
+        exec_driver=EXEC_DRIVER,
+        checksum=checksum,
+        delete=delete,
+        progress=progress,
+    )
+
+
 @_ensure_exists
 @_check_useruid
 def shell(name):
@@ -818,9 +1190,9 @@ def shell(name):
     return True
 
 
-def _pull_image(img_type, image, name, **kwargs):
+def _pull_cmd(img_type, image, name, **kwargs):
     """
-    Common logic function for pulling images
+    Validate a pull request and return the machinectl arguments
     """
     _ensure_systemd(219)
     if exists(name):
@@ -861,16 +1233,31 @@ def _pull_image(img_type, image, name, **kwargs):
                     _bad_verify()
                 pull_opt.append("--verify={}".format(verify))
 
-    cmd = "pull-{} {} {} {}".format(img_type, " ".join(pull_opt), image, name)
-    ret = _machinectl(cmd)
+    return "pull-{} {} {} {}".format(img_type, " ".join(pull_opt), image, name)
+
+
+def _pull_failed(ret):
+    """
+    Raise the error of a failed pull command
+    """
+    msg = (
+        "Error occurred while pulling image. Stderr from the pull command"
+        "(if any) follows:"
+    )
+    if ret["stderr"]:
+        msg += "\n\n{}".format(ret["stderr"])
+    raise Exception(msg)
+
+
+def _pull_image(img_type, image, name, **kwargs):
+    """
+    Common logic function for pulling images
+    """
+    cmd = _pull_cmd(img_type, image, name, **kwargs)
+    ret = machined.machinectl(cmd)
+    invalidate(name)
     if ret["returncode"] != 0:
-        msg = (
-            "Error occurred while pulling image. Stderr from the pull command"
-            "(if any) follows:"
-        )
-        if ret["stderr"]:
-            msg += "\n\n{}".format(ret["stderr"])
-        raise Exception(msg)
+        _pull_failed(ret)
     return True
 
 
@@ -925,18 +1312,49 @@ def clean_all():
     """
     Remove all VM and container images
     """
-    if list_running():
-        names = ", ".join(list_running())
+    running = list_running()
+    if running:
+        names = ", ".join(running)
         logger.warning(names + ": running. Unable to remove running VM or container.")
 
     if _sd_version() >= 219:
-        ret = _machinectl("clean --all")
+        ret = machined.machinectl("clean --all")
+        invalidate()
         if ret["returncode"] != 0:
             raise Exception("Unable to clean all images: '{}'".format(ret["stderr"]))
 
     return True
 
 
+def cache(action="stats", max_size=None):
+    """
+    Show the download cache ("stats") or evict the least recently used
+    artifacts until it fits max_size ("prune"). max_size becomes the
+    budget of later downloads, 0 empties the cache once.
+    """
+    artifacts = ArtifactCache()
+    if action == "stats":
+        stats = artifacts.stats()
+        ret = {
+            "Path": stats["path"],
+            "Artifacts": stats["objects"],
+            "URLs": stats["urls"],
+            "Size": human_size(stats["size"]),
+            "Limit": human_size(stats["max_size"]),
+        }
+        if stats["oldest_use"] is not None:
+            ret["Oldest Use"] = time.strftime(
+                "%a %Y-%m-%d %H:%M:%S %Z", time.localtime(stats["oldest_use"])
+            )
+        return ret
+    elif action == "prune":
+        if max_size is not None:
+            max_size = parse_size(max_size)
+        removed, freed = artifacts.prune(max_size)
+        return "Removed {} artifacts, {} freed".format(removed, human_size(freed))
+    raise Exception("Invalid cache action '{}'. Valid actions are: prune, stats".format(action))
+
+
 def _systemd_run(cmd):
     """
     Helper function to run systemd-run
@@ -947,13 +1365,19 @@ def _systemd_run(cmd):
 
 @_ensure_exists
 @_check_useruid
-def exec_run(name, cmd):
+def exec_run(name, cmd, stream=False):
     """
-    runs a new command in a running container
+    runs a new command in a running container. With stream=True the
+    output is not collected, a utils.cmd.Stream is returned instead.
     """
     if name not in list_running():
         start(name)
 
+    if stream:
+        if _ensure_consystemd(name):
+            return stream_cmd("systemd-run -M {} -P -q {}".format(name, cmd), is_shell=True)
+        return run_stream(name, cmd)
+
     if _ensure_consystemd(name):
         ret = _systemd_run("-M {} -P {}".format(name, cmd))
     else:
@@ -986,7 +1410,7 @@ def rename(name, newname, stop=False):
         raise Exception("Unable to rename container '{}': {}".format(name, exc))
 
     if _sd_version() >= 219:
-        ret = _machinectl("rename {} {}".format(name, newname))
+        ret = _machine_action("rename", name, newname)
         if ret["returncode"] != 0:
             _failed_rename(name, ret["stderr"])
     else:
@@ -996,13 +1420,15 @@ def rename(name, newname, stop=False):
             os.rename(_root(name=name), os.path.join(_root(), newname))
         except OSError as exc:
             _failed_rename(name, exc)
+    invalidate(name)
+    invalidate(newname)
 
     return True
 
 
-def _import_image(img_type, image, name):
+def _import_cmd(img_type, image, name):
     """
-    Common logic function for importing images
+    Validate an import request and return the machinectl arguments
     """
     _ensure_systemd(219)
     if exists(name):
@@ -1018,16 +1444,31 @@ def _import_image(img_type, image, name):
     else:
         raise Exception("Unsupported image type '{}'".format(img_type))
 
-    cmd = "import-{} {} {}".format(img_type, image, name)
-    ret = _machinectl(cmd)
+    return "import-{} {} {}".format(img_type, image, name)
+
+
+def _import_failed(ret):
+    """
+    Raise the error of a failed import command
+    """
+    msg = (
+        "Error occurred while importing image. Stderr from the import command"
+        "(if any) follows:"
+    )
+    if ret["stderr"]:
+        msg += "\n\n{}".format(ret["stderr"])
+    raise Exception(msg)
+
+
+def _import_image(img_type, image, name):
+    """
+    Common logic function for importing images
+    """
+    cmd = _import_cmd(img_type, image, name)
+    ret = machined.machinectl(cmd)
+    invalidate(name)
     if ret["returncode"] != 0:
-        msg = (
-            "Error occurred while importing image. Stderr from the import command"
-            "(if any) follows:"
-        )
-        if ret["stderr"]:
-            msg += "\n\n{}".format(ret["stderr"])
-        raise Exception(msg)
+        _import_failed(ret)
 
     return True
 
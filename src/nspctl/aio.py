@@ -0,0 +1,439 @@
+"""
+asyncio interface mirroring nspctl._nspctl. Copying into non-systemd
+containers and bootstrapping are synchronous by nature and run in the
+default executor.
+"""
+import asyncio
+import functools
+import logging
+import os
+
+from . import _nspctl
+from .lib.functools import alias_function
+from .utils import inventory
+from .utils.args import clean_kwargs
+from .utils.cmd import run_cmd_async
+from .utils.container_resource import cont_cmd, cont_cpt, proc_init
+from .utils.machined import machinectl_async
+from .utils.user import get_uid
+
+logger = logging.getLogger(__name__)
+
+# asyncio needs a separate process to wait on, so always nsenter here
+EXEC_DRIVER = "nsenter"
+
+
+async def _offload(func, *args, **kwargs):
+    """
+    Run a synchronous function in the default executor
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def _names(stdout):
+    """
+    First column of machinectl output, skipping continuation lines
+    """
+    ret = []
+    for line in (stdout or "").splitlines():
+        if line and not line[0].isspace():
+            ret.append(line.split()[0])
+    return ret
+
+
+def _check_useruid(wrapped):
+    """
+    Decorator check to user has root privileges, when the coroutine is
+    awaited
+    """
+    @functools.wraps(wrapped)
+    async def check_uid(*args, **kwargs):
+        if get_uid() != 0:
+            raise Exception("This command requires root privileges!")
+        return await wrapped(*args, **clean_kwargs(**kwargs))
+
+    return check_uid
+
+
+def _ensure_exists(wrapped):
+    """
+    Decorator to ensure that the named container exists
+    """
+
+    @functools.wraps(wrapped)
+    async def check_exists(name, *args, **kwargs):
+        if not await exists(name):
+            raise Exception("Container '{}' does not exist".format(name))
+        return await wrapped(name, *args, **kwargs)
+
+    return check_exists
+
+
+async def list_all():
+    """
+    Lists all nspawn containers
+    """
+    images = await _offload(inventory.collect_fs)
+    if images is not None:
+        return sorted(images)
+    if _nspctl._sd_version() >= 219:
+        ret = await machinectl_async("list-images")
+        if ret["returncode"] == 0:
+            return _names(ret["stdout"])
+    return await _offload(_nspctl.list_all)
+
+
+async def list_running():
+    """
+    Lists running nspawn containers
+    """
+    images = await _offload(inventory.collect_fs)
+    if images is not None:
+        return sorted(x for x, y in images.items() if y.state != "stopped")
+    ret = await machinectl_async("list")
+    return _names(ret["stdout"])
+
+
+alias_list = alias_function(list_running, "list")
+
+
+async def list_stopped():
+    """
+    Lists stopped nspawn containers
+    """
+    images = await _offload(inventory.collect_fs)
+    if images is not None:
+        return sorted(x for x, y in images.items() if y.state == "stopped")
+    all_, running = await asyncio.gather(list_all(), list_running())
+    return sorted(set(all_) - set(running))
+
+
+async def exists(name):
+    """
+    Return true if the named container exists
+    """
+    found = inventory.image_exists(name)
+    if found is not None:
+        return found
+    return name in await list_all()
+
+
+async def _status(name):
+    """
+    Return (state, leader PID) of a container
+    """
+    if os.path.isdir(inventory.MACHINES_DIR):
+        data = inventory.read_machine_file(name)
+        if data is not None:
+            if not data:
+                return "stopped", None
+            return data.get("STATE") or "running", data["LEADER"]
+    ret = await machinectl_async("show -p Leader -p State {}".format(name))
+    if ret["returncode"] != 0 or not ret["stdout"]:
+        return "stopped", None
+    props = dict(x.partition("=")[::2] for x in ret["stdout"].splitlines())
+    try:
+        leader = int(props.get("Leader"))
+    except (TypeError, ValueError):
+        leader = None
+    return props.get("State") or "stopped", leader
+
+
+@_ensure_exists
+async def state(name):
+    """
+    Return state of container (running or stopped)
+    """
+    return (await _status(name))[0]
+
+
+async def _ensure_running(name):
+    """
+    Start the container if it is not running
+    """
+    if (await _status(name))[0] == "running":
+        return True
+    return await start(name)
+
+
+@_ensure_exists
+async def con_pid(name):
+    """
+    Returns the PID of a container
+    """
+    leader = (await _status(name))[1]
+    if leader is None:
+        await _ensure_running(name)
+        leader = (await _status(name))[1]
+    try:
+        return int(leader)
+    except (TypeError, ValueError) as exc:
+        raise Exception(
+            "Unable to get PID for container '{}': {}".format(name, exc)
+        )
+
+
+async def _ensure_consystemd(name):
+    """
+    Detect container init systems:
+    systemd or other init systems
+    """
+    pid = await con_pid(name)
+    ret = proc_init(pid)
+    if ret is not None:
+        return ret
+    cmd = cont_cmd(pid, "stat /run/systemd/system",
+                   exec_driver=EXEC_DRIVER, keep_env=True)
+    return (await run_cmd_async(cmd, is_shell=True))["returncode"] == 0
+
+
+async def info(name=None, all_images=False, start=False):
+    """
+    Return info about a container
+    """
+    if all_images:
+        return await _offload(_nspctl.info_all)
+    if name is None:
+        raise Exception("Container name or --all is required")
+    if not await exists(name):
+        raise Exception("Container '{}' does not exist".format(name))
+    if not start:
+        await _ensure_running(name)
+    elif name not in await list_running():
+        await _start(name)
+    c_info = await machinectl_async("status {}".format(name))
+    if c_info["returncode"] != 0:
+        return "Unable to get info for container '{}'".format(name)
+    return _nspctl._parse_status(c_info["stdout"])
+
+
+async def _start(name):
+    """
+    Start a container, existence and privileges already checked
+    """
+    if _nspctl._sd_version() >= 219:
+        ret = await machinectl_async("start {}".format(name))
+    else:
+        cmd = "systemctl start systemd-nspawn@{}".format(name)
+        ret = await run_cmd_async(cmd, is_shell=True)
+    _nspctl.invalidate(name)
+    return ret["returncode"] == 0
+
+
+@_check_useruid
+@_ensure_exists
+async def start(name):
+    """
+    Start the named container
+    """
+    return await _start(name)
+
+
+@_check_useruid
+@_ensure_exists
+async def stop(name, kill=False):
+    """
+    This is a compatibility function which provides the logic for
+    poweroff and terminate.
+    """
+    if await _ensure_consystemd(name):
+        action = "terminate" if kill else "poweroff"
+        ret = await machinectl_async("{} {}".format(action, name))
+    else:
+        # systemd-nspawn can not stop other init systems
+        ret = await _run(name, "poweroff", preserve_state=True)
+    _nspctl.invalidate(name)
+
+    # command exit codes:
+    # terminate -> 143, kill -> 137
+    return ret["returncode"] in (0, 143)
+
+
+async def poweroff(name):
+    """
+    A clean shutdown to the container
+    """
+    return await stop(name, kill=False)
+
+
+async def terminate(name):
+    """
+    Kill all processes in the container. Not a clean shutdown.
+    """
+    return await stop(name, kill=True)
+
+
+@_check_useruid
+@_ensure_exists
+async def reboot(name):
+    """
+    reboot the container
+    """
+    if (await _status(name))[0] != "running":
+        return await _start(name)
+    if await _ensure_consystemd(name):
+        ret = await machinectl_async("reboot {}".format(name))
+    else:
+        ret = await _run(name, "reboot", preserve_state=True)
+    _nspctl.invalidate(name)
+    return ret["returncode"] in (0, 143)
+
+
+@_ensure_exists
+async def _run(
+    name,
+    cmd,
+    is_shell=True,
+    output=None,
+    preserve_state=False,
+    keep_env=None,
+):
+    """
+    Common logic for run coroutines
+    """
+    orig_state = (await _status(name))[0]
+    pid = await con_pid(name)
+    full_cmd = cont_cmd(pid, cmd, exec_driver=EXEC_DRIVER, keep_env=keep_env)
+    try:
+        ret = await run_cmd_async(full_cmd, is_shell=is_shell)
+    finally:
+        if (
+            preserve_state
+            and orig_state == "stopped"
+            and (await _status(name))[0] != "stopped"
+        ):
+            await stop(name)
+
+    if output is not None:
+        return ret[output]
+    return ret
+
+
+async def run(name, cmd, is_shell=True, preserve_state=True, keep_env=None):
+    """
+    Run command within a container
+    """
+    return await _run(name, cmd, is_shell=is_shell,
+                      preserve_state=preserve_state, keep_env=keep_env)
+
+
+async def run_stdout(name, cmd, is_shell=True, preserve_state=True, keep_env=None):
+    """
+    Run command within a container and response output stdout
+    """
+    return await _run(name, cmd, is_shell=is_shell, output="stdout",
+                      preserve_state=preserve_state, keep_env=keep_env)
+
+
+async def run_stderr(name, cmd, is_shell=True, preserve_state=True, keep_env=None):
+    """
+    Run command within a container and response output stderr
+    """
+    return await _run(name, cmd, is_shell=is_shell, output="stderr",
+                      preserve_state=preserve_state, keep_env=keep_env)
+
+
+async def retcode(name, cmd, is_shell=True, preserve_state=True, keep_env=None):
+    """
+    Run command within a container and response returncode
+    """
+    return await _run(name, cmd, is_shell=is_shell, output="returncode",
+                      preserve_state=preserve_state, keep_env=keep_env)
+
+
+@_check_useruid
+@_ensure_exists
+async def copy_to(name, source, dest, overwrite=False, makedirs=False):
+    """
+    Copy a file from host in to a container
+    """
+    if await _ensure_consystemd(name):
+        ret = await machinectl_async("copy-to {} {} '{}'".format(name, source, dest))
+        if ret["returncode"] != 0:
+            raise Exception("Failed to copying file/s")
+        return ret
+    orig_state = (await _status(name))[0]
+    pid = await con_pid(name)
+    return await _offload(
+        cont_cpt,
+        pid,
+        source,
+        dest,
+        state=orig_state,
+        container_type=_nspctl.__virtualname__,
+        exec_driver=_nspctl.EXEC_DRIVER,
+        overwrite=overwrite,
+        makedirs=makedirs,
+    )
+
+
+async def _machinectl_image(cmd, name, failed):
+    """
+    Run a machinectl pull or import command
+    """
+    ret = await machinectl_async(cmd)
+    _nspctl.invalidate(name)
+    if ret["returncode"] != 0:
+        failed(ret)
+    return True
+
+
+@_check_useruid
+async def pull_raw(url, name, verify=False):
+    """
+    Execute a ``machinectl pull-raw`` to download a .qcow2 or raw disk image,
+    and add it to /var/lib/machines as a new container.
+    """
+    cmd = await _offload(_nspctl._pull_cmd, "raw", url, name, verify=verify)
+    return await _machinectl_image(cmd, name, _nspctl._pull_failed)
+
+
+@_check_useruid
+async def pull_tar(url, name, verify=False):
+    """
+    Execute a ``machinectl pull-tar`` to download a .tar container image,
+    and add it to /var/lib/machines as a new container.
+    """
+    cmd = await _offload(_nspctl._pull_cmd, "tar", url, name, verify=verify)
+    return await _machinectl_image(cmd, name, _nspctl._pull_failed)
+
+
+@_check_useruid
+async def import_raw(image, name):
+    """
+    Execute a ``machinectl import-raw`` to import a .qcow2 or raw disk image,
+    and add it to /var/lib/machines as a new container.
+    """
+    cmd = await _offload(_nspctl._import_cmd, "raw", image, name)
+    return await _machinectl_image(cmd, name, _nspctl._import_failed)
+
+
+@_check_useruid
+async def import_tar(image, name):
+    """
+    Execute a ``machinectl import-tar`` to import a .tar container image,
+    and add it to /var/lib/machines as a new container.
+    """
+    cmd = await _offload(_nspctl._import_cmd, "tar", image, name)
+    return await _machinectl_image(cmd, name, _nspctl._import_failed)
+
+
+@_check_useruid
+async def import_fs(directory, name):
+    """
+    Execute a ``machinectl import-fs`` to import a directory image,
+    and add it to /var/lib/machines as a new container.
+    """
+    cmd = await _offload(_nspctl._import_cmd, "fs", directory, name)
+    return await _machinectl_image(cmd, name, _nspctl._import_failed)
+
+
+async def bootstrap_container(name, dist=None, version=None):
+    """
+    Bootstrap a container from package servers
+    """
+    return await _offload(_nspctl.bootstrap_container, name, dist=dist, version=version)
+
+
+bootstrap = alias_function(bootstrap_container, "bootstrap")
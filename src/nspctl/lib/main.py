@@ -3,7 +3,10 @@ import logging
 import sys
 
 from ..utils.platform import is_linux
-from ..utils.systemd import systemd_booted, systemd_version
+from ..utils.systemd import systemd_booted
+from ..utils.host import host_systemd_version
+from ..utils.cmd import Stream
+from ..utils.container_resource import human_size
 from .output import nprint
 from .. import _nspctl, __version__
 from .usage import nspctl_usage
@@ -16,7 +19,7 @@ def check_system():
     Only work on systems that have been booted with systemd
     """
     if is_linux() and systemd_booted():
-        if systemd_version() is None:
+        if host_systemd_version() is None:
             logger.error("nspctl: Unable to determine systemd version")
         else:
             return True
@@ -52,10 +55,7 @@ no_args = {
     },
 }
 
-one_args = {
-    "info": {
-        "help": "Show properties of container",
-    },
+bulk_args = {
     "start": {
         "help": "Start a container as system service",
     },
@@ -79,6 +79,9 @@ one_args = {
         "aliases": ["dis"],
         "help": "Disable a container as a system service at system boot",
     },
+}
+
+one_args = {
     "remove": {
         "aliases": ["rm"],
         "help": "Remove a container completely",
@@ -123,6 +126,20 @@ def parser_opts():
         sp = subparsers.add_parser(*sargs, **kwargs)
         sp.set_defaults(func=myopt)
 
+    for myopt, kwargs in bulk_args.items():
+        sargs = [myopt]
+        sp = subparsers.add_parser(*sargs, **kwargs)
+        sp.add_argument("name", nargs="*",
+                        help="container names or glob patterns")
+        selector = sp.add_mutually_exclusive_group()
+        for sel in ("all", "running", "stopped"):
+            selector.add_argument("--{}".format(sel), dest="selector",
+                                  action="store_const", const=sel,
+                                  help="select {} containers".format(sel))
+        sp.add_argument("--parallel", type=int, default=1, metavar="N",
+                        help="run on up to N containers at a time")
+        sp.set_defaults(func=myopt)
+
     for myopt, kwargs in one_args.items():
         sargs = [myopt]
         sp = subparsers.add_parser(*sargs, **kwargs)
@@ -144,6 +161,15 @@ def parser_opts():
         sp.add_argument("name")
         sp.set_defaults(func=myopt)
 
+    # info arguments
+    sp = subparsers.add_parser("info",
+                               help="Show properties of container",
+                               )
+    sp.add_argument("name", nargs="?")
+    sp.add_argument("--all", dest="all_images", action="store_true",
+                    help="Show properties of all containers")
+    sp.set_defaults(func="info")
+
     # rename arguments
     sp = subparsers.add_parser("rename",
                                help="Renames a container or VM image",
@@ -167,16 +193,52 @@ def parser_opts():
                                help="Copies files from the host system into a running container",
                                )
     sp.add_argument("name")
-    sp.add_argument("source")
+    sp.add_argument("source", nargs="+")
     sp.add_argument("dest")
     sp.set_defaults(func="copy-to")
 
+    # copy_from arguments
+    sp = subparsers.add_parser("copy-from",
+                               aliases=["cpf"],
+                               help="Copies files from a container to the host system",
+                               )
+    sp.add_argument("name")
+    sp.add_argument("source")
+    sp.add_argument("dest")
+    sp.add_argument("--compress", choices=["gz", "bz2", "xz"],
+                    help="Write a compressed tar archive")
+    sp.set_defaults(func="copy-from")
+
+    # sync arguments
+    sp = subparsers.add_parser("sync",
+                               help="Updates a container directory from a host directory",
+                               )
+    sp.add_argument("name")
+    sp.add_argument("source")
+    sp.add_argument("dest")
+    sp.add_argument("--checksum", choices=["MD5", "SHA1", "SHA256", "SHA512"],
+                    help="Compare files by content instead of mtime")
+    sp.add_argument("--delete", action="store_true",
+                    help="Remove files which are not in the source directory")
+    sp.set_defaults(func="sync")
+
+    # cache arguments
+    sp = subparsers.add_parser("cache",
+                               help="Shows or prunes the download cache",
+                               )
+    sp.add_argument("action", choices=["stats", "prune"])
+    sp.add_argument("--max-size",
+                    help="Size to prune the cache to and keep it at, like 500M or 2G (0 empties it)")
+    sp.set_defaults(func="cache")
+
     # exec arguments
     sp = subparsers.add_parser("exec",
                                help="Run a new command in a running container",
                                )
     sp.add_argument("name")
     sp.add_argument("cmd")
+    sp.add_argument("--stream", action="store_true",
+                    help="Print the output as it arrives")
     sp.set_defaults(func="exec-run")
 
     vargs = parser.parse_args()
@@ -191,6 +253,8 @@ class NspctlCmd(object):
     def __init__(self):
         self.cmd = None
         self.resp_string = None
+        self.failed = False
+        self._shown = None
 
     def action(self, args):
         """
@@ -210,12 +274,70 @@ class NspctlCmd(object):
         Run the function from _nspctl.py
         """
         cmd = cmd.lstrip("-").replace("-", "_")
-        method = getattr(_nspctl, cmd)
-        result = method(**args)
+        if cmd in bulk_args:
+            result = self.run_bulk(cmd, args)
+        else:
+            if cmd in ("copy_to", "copy_from", "sync") and sys.stderr.isatty():
+                args["progress"] = self.show_progress
+            method = getattr(_nspctl, cmd)
+            result = method(**args)
+            if self._shown is not None:
+                sys.stderr.write("\n")
+        if isinstance(result, Stream):
+            return self.write_stream(result)
         fancy_result = nprint(result)
 
         return fancy_result
 
+    def show_progress(self, done, total, elapsed):
+        """
+        Progress line of a copy, refreshed a few times per second
+        """
+        if self._shown is not None and elapsed - self._shown < 0.2:
+            return
+        self._shown = elapsed
+        rate = done / elapsed if elapsed else 0
+        line = "{} ({}/s) ".format(human_size(done), human_size(rate))
+        if total:
+            line = "{:3d}% {}".format(min(100, done * 100 // total), line)
+        sys.stderr.write("\r" + line)
+        sys.stderr.flush()
+
+    def write_stream(self, stream):
+        """
+        Copy the output of a command to ours as it arrives
+        """
+        for name, data in stream:
+            out = sys.stdout if name == "stdout" else sys.stderr
+            out.write(data)
+            out.flush()
+        self.failed = stream.returncode != 0
+        return ""
+
+    def run_bulk(self, cmd, args):
+        """
+        Run a lifecycle command on one or many containers
+        """
+        names = args["name"]
+        selector = args["selector"]
+        parallel = args["parallel"]
+        if not names and selector is None:
+            raise Exception("Container name, pattern or selector is required")
+
+        # a single plain name keeps the classic output
+        if (
+            selector is None
+            and len(names) == 1
+            and not any(x in names[0] for x in "*?[")
+        ):
+            result = getattr(_nspctl, cmd)(names[0])
+            self.failed = result is not True
+            return result
+
+        result = _nspctl.bulk(cmd, names=names, selector=selector, parallel=parallel)
+        self.failed = bool(_nspctl.bulk_failed(result))
+        return result
+
     def get_result(self):
         """
         Returns the response
@@ -244,4 +366,7 @@ def nspctl_main(args=None):
         nsp = NspctlCmd()
         nsp.action(args_map)
         rev = nsp.get_result()
-        print(rev)
+        if rev:
+            print(rev)
+        if nsp.failed:
+            sys.exit(1)
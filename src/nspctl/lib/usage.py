@@ -77,6 +77,29 @@ def nspctl_usage():
         + turquoise("container name")
         + " ] "
     )
+    print(
+        "   "
+        + turquoise("nspctl")
+        + " [ "
+        + green("start")
+        + " | "
+        + green("stop")
+        + " | "
+        + green("...")
+        + " ] [ "
+        + turquoise("container name")
+        + " | "
+        + turquoise("pattern")
+        + " ... ] [ "
+        + green("--all")
+        + " | "
+        + green("--running")
+        + " | "
+        + green("--stopped")
+        + " ] [ "
+        + green("--parallel N")
+        + " ] "
+    )
     print(
         "   "
         + turquoise("nspctl")
@@ -103,11 +126,50 @@ def nspctl_usage():
         + " ] [ "
         + turquoise("container name")
         + " ] [ "
+        + green("Host Path...")
+        + " ] [ "
+        + green("Container Path")
+        + " ] "
+    )
+    print(
+        "   "
+        + turquoise("nspctl")
+        + " [ "
+        + green("copy-from")
+        + " ] [ "
+        + turquoise("container name")
+        + " ] [ "
+        + green("Container Path")
+        + " ] [ "
+        + green("Host Path")
+        + " ] "
+    )
+    print(
+        "   "
+        + turquoise("nspctl")
+        + " [ "
+        + green("sync")
+        + " ] [ "
+        + turquoise("container name")
+        + " ] [ "
         + green("Host Path")
         + " ] [ "
         + green("Container Path")
         + " ] "
     )
+    print(
+        "   "
+        + turquoise("nspctl")
+        + " [ "
+        + green("cache")
+        + " ] [ "
+        + turquoise("stats")
+        + " | "
+        + turquoise("prune")
+        + " ] [ "
+        + green("--max-size SIZE")
+        + " ] "
+    )
     print(
         "   "
         + turquoise("nspctl")
@@ -128,6 +190,8 @@ def nspctl_usage():
         + turquoise("container name")
         + " ] [ "
         + turquoise("command")
+        + " ] [ "
+        + turquoise("--stream")
         + " ] "
     )
     print(
@@ -238,6 +302,19 @@ def nspctl_usage():
         + " ] [ "
         + turquoise("container name")
         + " ] [ "
+        + turquoise("source...")
+        + " ] [ "
+        + turquoise("destination")
+        + " ] "
+    )
+    print(
+        "   "
+        + turquoise("nspctl")
+        + " [ "
+        + green("cpf -> copy-from")
+        + " ] [ "
+        + turquoise("container name")
+        + " ] [ "
         + turquoise("source")
         + " ] [ "
         + turquoise("destination")
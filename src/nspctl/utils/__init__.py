@@ -1 +1 @@
-__all__ = ["args", "path", "platform", "systemd", "cmd", "container_resource", "user", "tar", "getfile", "checksum"]
+__all__ = ["args", "path", "platform", "systemd", "cmd", "container_resource", "user", "tar", "getfile", "checksum", "host", "dbus", "machined", "inventory", "nsexec", "agent", "rootfs", "cache"]
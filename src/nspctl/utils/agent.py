@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+from .container_resource import _proc_key
+from .nsexec import collect, enter, exec_here, open_namespaces
+
+logger = logging.getLogger(__name__)
+
+# requests and replies are JSON documents prefixed by their length
+_HEADER = struct.Struct("!I")
+
+# isolated mode (-I) keeps the working directory, user site and PYTHON*
+# variables off sys.path of this root process, nspctl is imported from
+# where we were loaded
+_AGENT_MAIN = (
+    "import sys; sys.path.insert(0, sys.argv[1]); "
+    "from nspctl.utils.agent import main; main(sys.argv[2:])"
+)
+
+# live agents by container name
+_agents = {}
+_lock = threading.Lock()
+
+
+def _send(sock, obj):
+    data = json.dumps(obj).encode()
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _recv(sock):
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exact(sock, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return json.loads(data.decode())
+
+
+def _serve(sock, ns_fds):
+    """
+    Agent side: join the namespaces once, then run one command per
+    request until the other end goes away. Never returns.
+    """
+    code = 0
+    try:
+        # the terminal's ^C is for nspctl, we leave when it is gone
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # a fresh interpreter is single threaded, no throwaway thread needed
+        enter(ns_fds)
+        # drop everything inherited from nspctl, other agents included,
+        # so they still see end of file when nspctl closes them
+        fd = sock.fileno()
+        os.closerange(3, fd)
+        os.closerange(fd + 1, os.sysconf("SC_OPEN_MAX"))
+        while True:
+            req = _recv(sock)
+            if req is None:
+                break
+            argv, env = req["argv"], req["env"]
+            _send(sock, collect(
+                lambda out, err: exec_here(argv, env, None, out, err)
+            ))
+    except BaseException:
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def main(args):
+    """
+    Entry point of the agent process: the socket and namespace file
+    descriptors handed over by Agent
+    """
+    fds = [int(x) for x in args]
+    _serve(socket.socket(fileno=fds[0]), fds[1:])
+
+
+class Agent:
+    """
+    Helper process attached to the namespaces of a container. Commands
+    are sent over a socket pair, so each one costs a posix_spawn() in the
+    container instead of a namespace entry.
+    """
+
+    def __init__(self, pid):
+        self.leader = pid
+        self.key = _proc_key(pid)
+        self._lock = threading.Lock()
+        ns_fds = open_namespaces(pid)
+        ours, theirs = socket.socketpair()
+        fds = [theirs.fileno()] + ns_fds
+        # a fresh interpreter rather than fork(): nspctl may run other
+        # threads, whose locks a forked child would inherit held
+        top = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        try:
+            self.proc = subprocess.Popen(
+                [sys.executable, "-I", "-c", _AGENT_MAIN, top] + [str(x) for x in fds],
+                stdin=subprocess.DEVNULL,
+                pass_fds=fds,
+                cwd="/",
+            )
+        except OSError:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+            for fd in ns_fds:
+                os.close(fd)
+        self.pid = self.proc.pid
+        self.sock = ours
+
+    def current(self):
+        """
+        Return true if the agent is up and the container leader it was
+        attached to is still the same process
+        """
+        return self.sock is not None and _proc_key(self.leader) == self.key
+
+    def run(self, argv, env):
+        """
+        Run a command in the container, returns a run_cmd style dict or
+        None if the agent is gone
+        """
+        with self._lock:
+            if self.sock is None:
+                return None
+            try:
+                _send(self.sock, {"argv": argv, "env": env})
+                ret = _recv(self.sock)
+            except (OSError, ValueError) as exc:
+                logger.debug("Exec agent %s failed: %s", self.pid, exc)
+                ret = None
+            if ret is None:
+                self._close()
+        return ret
+
+    def _close(self):
+        if self.sock is None:
+            return
+        self.sock.close()
+        self.sock = None
+        # between requests the agent only waits for the next one
+        self.proc.kill()
+        self.proc.wait()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+def get_agent(name):
+    """
+    Return the agent of a container, None if there is none or the
+    container leader changed since it was attached
+    """
+    with _lock:
+        agent = _agents.get(name)
+        if agent is None or agent.current():
+            return agent
+        del _agents[name]
+    agent.close()
+    return None
+
+
+def attach(name, pid):
+    """
+    Start an agent in the namespaces of the container leader pid
+    """
+    agent = Agent(pid)
+    with _lock:
+        old = _agents.get(name)
+        _agents[name] = agent
+    if old is not None:
+        old.close()
+    return agent
+
+
+def detach(name=None):
+    """
+    Stop the agent of a container, or all agents
+    """
+    with _lock:
+        if name is None:
+            agents = list(_agents.values())
+            _agents.clear()
+        else:
+            agents = [_agents.pop(name)] if name in _agents else []
+    for agent in agents:
+        agent.close()
@@ -0,0 +1,244 @@
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from .checksum import perform_checksum, verify_all
+from .getfile import file_get
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "index.json"
+INDEX_FORMAT = 1
+# size budget of the artifact cache until one is set with prune()
+MAX_SIZE = 2 << 30
+
+
+def cache_dir():
+    """
+    Return the directory downloaded artifacts are kept in
+    """
+    if os.geteuid() == 0:
+        return "/var/cache/nspctl"
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "nspctl")
+
+
+def parse_size(size):
+    """
+    Bytes of a size like 500M or 2G, plain numbers are bytes
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    text = str(size).strip().upper().rstrip("IB") or "0"
+    try:
+        if text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise Exception("Invalid size '{}'".format(size))
+
+
+class ArtifactCache:
+    """
+    Downloaded files stored by their SHA256 under objects/, with an index
+    of URLs to digests and the last use of every object. The least
+    recently used objects go first when the cache outgrows max_size,
+    which defaults to the budget stored in the index.
+    """
+
+    def __init__(self, path=None, max_size=None):
+        self.path = path or cache_dir()
+        self.max_size = max_size
+        self.index_path = os.path.join(self.path, INDEX_NAME)
+
+    def _budget(self, index):
+        if self.max_size is not None:
+            return self.max_size
+        return index.get("max_size", MAX_SIZE)
+
+    def _object(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Hold the cache lock and yield the index, saved afterwards. Other
+        nspctl processes wait for the lock.
+        """
+        os.makedirs(self.path, mode=0o755, exist_ok=True)
+        with open(os.path.join(self.path, ".lock"), "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            index = self._load()
+            yield index
+            self._save(index)
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        if not isinstance(data, dict) or data.get("format") != INDEX_FORMAT:
+            return {"format": INDEX_FORMAT, "urls": {}, "objects": {}}
+        return data
+
+    def _save(self, index):
+        """
+        Atomically write the index
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=".index.")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(temp_path, self.index_path)
+
+    def _drop(self, index, digest):
+        """
+        Remove an object and the URLs pointing to it
+        """
+        index["objects"].pop(digest, None)
+        for url in [x for x, y in index["urls"].items() if y == digest]:
+            del index["urls"][url]
+        try:
+            os.unlink(self._object(digest))
+        except FileNotFoundError:
+            pass
+
+    def lookup(self, url, digests=None):
+        """
+        Return the path of the cached copy of url, or of any object with
+        the SHA256 in digests, None on a miss. Other digests are verified
+        against the object.
+        """
+        digests = digests or {}
+        with self._locked() as index:
+            digest = digests.get("SHA256")
+            if digest not in index["objects"]:
+                digest = index["urls"].get(url)
+            entry = index["objects"].get(digest)
+            if entry is None or digests.get("SHA256") not in (None, digest):
+                # the URL changed content since it was cached
+                return None
+            path = self._object(digest)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = None
+            if size != entry["size"]:
+                logger.warning("Cached copy of '%s' is damaged, dropping it", url)
+                self._drop(index, digest)
+                return None
+            if digests.get("size") not in (None, size):
+                return None
+            if set(digests) - {"SHA256", "size"} and not verify_all(path, digests)[0]:
+                return None
+            entry["used"] = time.time()
+            index["urls"][url] = digest
+        return path
+
+    def add(self, url, path, digest=None):
+        """
+        Move a downloaded file into the cache, returns the object path
+        """
+        if digest is None:
+            digest = perform_checksum(path, "SHA256")[0]
+        obj = self._object(digest)
+        os.makedirs(os.path.dirname(obj), mode=0o755, exist_ok=True)
+        os.chmod(path, 0o444)
+        with self._locked() as index:
+            os.replace(path, obj)
+            index["objects"][digest] = {"size": os.path.getsize(obj), "used": time.time()}
+            index["urls"][url] = digest
+        return obj
+
+    def fetch(self, url, dest, digests=None, size=None, segments=1):
+        """
+        file_get() through the cache: a hit is hardlinked (or copied) to
+        dest, a miss is downloaded into the cache first. Returns 0 on
+        success like file_get().
+        """
+        target = os.path.join(dest, os.path.basename(url))
+        expected = dict(digests or {})
+        if size is not None:
+            expected["size"] = size
+        try:
+            obj = self.lookup(url, expected)
+            added = obj is None
+            if added:
+                # one directory per URL, so a broken download resumes
+                tmp = os.path.join(
+                    self.path, "tmp", hashlib.sha256(url.encode()).hexdigest()[:16]
+                )
+                os.makedirs(tmp, mode=0o700, exist_ok=True)
+                if file_get(url, tmp, digests=digests, size=size, segments=segments) != 0:
+                    return 1
+                obj = self.add(
+                    url, os.path.join(tmp, os.path.basename(url)), expected.get("SHA256")
+                )
+                shutil.rmtree(tmp, ignore_errors=True)
+            else:
+                logger.info("Using cached '%s'", os.path.basename(url))
+        except OSError as exc:
+            logger.warning("Artifact cache %s unusable: %s", self.path, exc)
+            return file_get(url, dest, digests=digests, size=size, segments=segments)
+
+        os.makedirs(dest, exist_ok=True)
+        if os.path.lexists(target):
+            os.unlink(target)
+        try:
+            os.link(obj, target)
+        except OSError as exc:
+            if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(obj, target)
+        if added:
+            # only a download grows the cache
+            self.prune()
+        return 0
+
+    def stats(self):
+        """
+        Return a dict describing the cache
+        """
+        with self._locked() as index:
+            size = sum(x["size"] for x in index["objects"].values())
+            used = [x["used"] for x in index["objects"].values()]
+            return {
+                "path": self.path,
+                "objects": len(index["objects"]),
+                "urls": len(index["urls"]),
+                "size": size,
+                "max_size": self._budget(index),
+                "oldest_use": min(used) if used else None,
+            }
+
+    def prune(self, max_size=None):
+        """
+        Evict least recently used objects until the cache fits max_size.
+        A max_size other than 0 is stored as the budget of later
+        downloads. Returns the number of objects removed and the bytes
+        freed.
+        """
+        removed = freed = 0
+        with self._locked() as index:
+            if max_size is None:
+                max_size = self._budget(index)
+            elif max_size:
+                index["max_size"] = max_size
+            total = sum(x["size"] for x in index["objects"].values())
+            for digest, entry in sorted(index["objects"].items(), key=lambda x: x[1]["used"]):
+                if total <= max_size:
+                    break
+                self._drop(index, digest)
+                total -= entry["size"]
+                removed += 1
+                freed += entry["size"]
+            if max_size == 0:
+                # leftovers of interrupted downloads
+                shutil.rmtree(os.path.join(self.path, "tmp"), ignore_errors=True)
+        return removed, freed
@@ -1,13 +1,20 @@
 import errno
 import functools
 import hashlib
+import mmap
 import os
 import re
 import stat
+from concurrent.futures import ThreadPoolExecutor
 
 hashfunc_map = {}
 hashorigin_map = {}
 
+# read size of the hashing loop, one buffer is reused for the whole file
+BLOCKSIZE = 1 << 20
+# regular files from this size on are hashed from a read only mapping
+MMAP_MIN = 1 << 20
+
 
 def _open_file(filename):
     """
@@ -29,6 +36,54 @@ def _open_file(filename):
             raise
 
 
+def _hash_mapped(mapped, hashobjects, blocksize):
+    """
+    Feed all hash objects from a file mapping, blocksize bytes at a time
+    so each block is hashed by every object while it is in cache
+    """
+    size = len(mapped)
+    with mapped:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for offset in range(0, size, blocksize):
+                with view[offset:offset + blocksize] as chunk:
+                    for checksum in hashobjects:
+                        checksum.update(chunk)
+    return size
+
+
+def _hash_file(filename, hashobjects, blocksize=None, use_mmap=True):
+    """
+    Feed all hash objects from a single pass over a file, returns the
+    number of bytes read. A file which may be truncated while it is
+    hashed must not be mapped, that would kill us with SIGBUS.
+    """
+    blocksize = blocksize or BLOCKSIZE
+    with _open_file(filename) as f:
+        st = os.fstat(f.fileno())
+        if use_mmap and stat.S_ISREG(st.st_mode) and st.st_size >= MMAP_MIN:
+            try:
+                mapped = mmap.mmap(f.fileno(), st.st_size, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # no mapping on this file system, read it instead
+                mapped = None
+            if mapped is not None:
+                return _hash_mapped(mapped, hashobjects, blocksize)
+        buf = bytearray(blocksize)
+        view = memoryview(buf)
+        size = 0
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            chunk = view[:n]
+            for checksum in hashobjects:
+                checksum.update(chunk)
+            size += n
+    return size
+
+
 class _generate_hash_function:
     """
     Generate a hash function
@@ -46,17 +101,12 @@ class _generate_hash_function:
         checksum.update(data)
         return checksum.hexdigest()
 
-    def checksum_file(self, filename):
-        with _open_file(filename) as f:
-            blocksize = 32768
-            size = 0
-            checksum = self._hashobject()
-            data = f.read(blocksize)
-            while data:
-                checksum.update(data)
-                size = size + len(data)
-                data = f.read(blocksize)
+    def new(self):
+        return self._hashobject()
 
+    def checksum_file(self, filename, blocksize=None, use_mmap=True):
+        checksum = self._hashobject()
+        size = _hash_file(filename, (checksum,), blocksize, use_mmap)
         return checksum.hexdigest(), size
 
 
@@ -71,7 +121,7 @@ class SizeHash:
     """
     Size implementation class
     """
-    def checksum_file(self, filename):
+    def checksum_file(self, filename, blocksize=None, use_mmap=True):
         size = os.stat(filename).st_size
         return size, size
 
@@ -81,23 +131,49 @@ hashfunc_map["size"] = SizeHash()
 hashfunc_keys = frozenset(hashfunc_map)
 
 
-def perform_checksum(filename, hashname="MD5"):
+def _file_error(filename, exc):
+    """
+    Raise the error of a failed read of filename
+    """
+    if exc.errno in (errno.ENOENT, errno.ESTALE):
+        raise Exception("{} : File not found".format(filename))
+    elif exc.errno == errno.EACCES:
+        raise Exception("{} : Permission denied".format(filename))
+    raise exc
+
+
+def perform_checksum(filename, hashname="MD5", blocksize=None):
     """
     Run a specific checksum against a file
     """
     try:
         if hashname not in hashfunc_keys:
             raise Exception("{} , hash function not available".format(hashname))
-        myhash, mysize = hashfunc_map[hashname].checksum_file(filename)
+        myhash, mysize = hashfunc_map[hashname].checksum_file(filename, blocksize)
     except (OSError, IOError) as exc:
-        if exc.errno in (errno.ENOENT, errno.ESTALE):
-            raise Exception("{} : File not found".format(filename))
-        elif exc.errno == errno.EACCES:
-            raise Exception("{} : Permission denied".format(filename))
-        raise
+        _file_error(filename, exc)
     return myhash, mysize
 
 
+def perform_checksums(filename, hashnames, blocksize=None, use_mmap=True):
+    """
+    Run several checksums against a file reading it only once. Returns a
+    dict of hash name to digest, "size" maps to the file size.
+    """
+    for hashname in hashnames:
+        if hashname not in hashfunc_keys:
+            raise Exception("{} , hash function not available".format(hashname))
+    checksums = {x: hashfunc_map[x].new() for x in hashnames if x != "size"}
+    try:
+        mysize = _hash_file(filename, list(checksums.values()), blocksize, use_mmap)
+    except (OSError, IOError) as exc:
+        _file_error(filename, exc)
+    mydict = {x: y.hexdigest() for x, y in checksums.items()}
+    if "size" in hashnames:
+        mydict["size"] = mysize
+    return mydict
+
+
 def verify_all(filename, mydict, strict=0):
     """
     Verify all checksums against a file
@@ -132,11 +208,13 @@ def verify_all(filename, mydict, strict=0):
         got = " ".join(got)
         return False, ("Insufficient data for checksum verification", got, expected)
 
+    # one read of the file for all hash types
+    myhashes = perform_checksums(filename, verifiable_hash_types)
     for x in sorted(mydict):
         if x == "size":
             continue
         elif x in hashfunc_keys:
-            myhash = perform_checksum(filename, x)[0]
+            myhash = myhashes[x]
             if mydict[x] != myhash:
                 if strict:
                     raise Exception(
@@ -151,6 +229,86 @@ def verify_all(filename, mydict, strict=0):
     return file_is_ok, reason
 
 
+class StreamVerifier:
+    """
+    verify_all() for data seen once, like a download: feed the chunks to
+    update() as they arrive and call verify() after the last one
+    """
+
+    __slots__ = ("expected", "size", "_hashes")
+
+    def __init__(self, mydict):
+        self.expected = mydict
+        self.size = 0
+        self._hashes = {
+            x: hashfunc_map[x].new() for x in mydict if x in hashfunc_keys and x != "size"
+        }
+
+    def update(self, data):
+        """
+        Hash a chunk, returns false once more data arrived than expected
+        """
+        for checksum in self._hashes.values():
+            checksum.update(data)
+        self.size += len(data)
+        return self.expected.get("size") is None or self.size <= self.expected["size"]
+
+    def verify(self):
+        """
+        Return (file_is_ok, reason) like verify_all()
+        """
+        if self.expected.get("size") is not None and self.expected["size"] != self.size:
+            return False, (
+                "File size does not match recorded size",
+                self.size,
+                self.expected["size"],
+            )
+        for x in sorted(self._hashes):
+            myhash = self._hashes[x].hexdigest()
+            if self.expected[x] != myhash:
+                return False, (
+                    "Failed on {} verification".format(x), myhash, self.expected[x]
+                )
+        return True, "Reason unknown"
+
+
+def _pool_map(func, items, workers=None):
+    """
+    Map func over items from a thread pool. hashlib drops the GIL while
+    it hashes large blocks, so files are hashed in parallel.
+    """
+    items = list(items)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(int(workers), len(items)))
+    if workers == 1:
+        return [func(x) for x in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+
+def checksum_files(filenames, hashnames, workers=None, blocksize=None):
+    """
+    perform_checksums() for many files at once, returns a dict of file
+    name to digests
+    """
+    filenames = list(filenames)
+    return dict(zip(filenames, _pool_map(
+        lambda x: perform_checksums(x, hashnames, blocksize), filenames, workers
+    )))
+
+
+def verify_many(files, strict=0, workers=None):
+    """
+    verify_all() for many files at once. files maps file names to their
+    checksum dicts, returns a dict of file name to verify_all() result.
+    """
+    filenames = list(files)
+    return dict(zip(filenames, _pool_map(
+        lambda x: verify_all(x, files[x], strict), filenames, workers
+    )))
+
+
 def perform_md5(filename):
     """
     Shortcut for performing md5 checksum
@@ -169,10 +327,7 @@ def perform_all(filename):
     """
     Performing for all verifiable_hash_types
     """
-    mydict = {}
-    for k in hashfunc_keys:
-        mydict[k] = perform_checksum(filename, k)[0]
-    return mydict
+    return perform_checksums(filename, hashfunc_keys)
 
 
 def get_valid_checksum_keys():
@@ -1,10 +1,144 @@
+import asyncio
+import io
+import os
+import selectors
+import signal
 import subprocess
 import shlex
+import tempfile
 
+STREAM_CHUNK = 65536
 
-def run_cmd(cmd, is_shell, cwd=None):
+
+class Capture:
+    """
+    How much command output run_cmd keeps, and in which form.
+
+    max_memory: bytes kept in memory per stream, past that the output
+    goes to an anonymous temporary file which is returned instead of a
+    string. None keeps everything in memory.
+    head, tail: only keep the first and/or last bytes of the output, the
+    rest is replaced by a marker.
+    raw: return bytes (or a binary file) without decoding or stripping.
+    """
+
+    __slots__ = ("max_memory", "head", "tail", "raw")
+
+    def __init__(self, max_memory=None, head=None, tail=None, raw=False):
+        self.max_memory = max_memory
+        self.head = head
+        self.tail = tail
+        self.raw = raw
+
+
+class _Sink:
+    """
+    Output of one stream, collected according to a Capture
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.size = 0
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.body = bytearray()
+        self.file = None
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        policy = self.policy
+        if policy.head is not None or policy.tail is not None:
+            if policy.head and len(self.head) < policy.head:
+                take = policy.head - len(self.head)
+                self.head += chunk[:take]
+                chunk = chunk[take:]
+            if policy.tail and chunk:
+                self.tail += chunk
+                # trim in batches, not on every chunk
+                if len(self.tail) > 2 * policy.tail:
+                    del self.tail[:-policy.tail]
+            return
+        if (
+            self.file is None
+            and policy.max_memory is not None
+            and len(self.body) + len(chunk) > policy.max_memory
+        ):
+            self.file = tempfile.TemporaryFile()
+            self.file.write(self.body)
+            self.body = None
+        if self.file is not None:
+            self.file.write(chunk)
+        else:
+            self.body += chunk
+
+    def value(self):
+        """
+        The collected output: str, bytes, a file object or None
+        """
+        policy = self.policy
+        if self.file is not None:
+            self.file.seek(0)
+            if policy.raw:
+                return self.file
+            return io.TextIOWrapper(self.file, errors="replace")
+        if policy.head is not None or policy.tail is not None:
+            tail = self.tail[-policy.tail:] if policy.tail else b""
+            omitted = self.size - len(self.head) - len(tail)
+            data = bytes(self.head)
+            if omitted:
+                data += "\n... [{} bytes omitted] ...\n".format(omitted).encode()
+            data += tail
+        else:
+            data = bytes(self.body)
+        if policy.raw:
+            return data if data else None
+        data = data.decode(errors="replace").rstrip()
+        return data if data else None
+
+
+def _output(data):
+    if not isinstance(data, str):
+        # a capture policy already shaped it, raw bytes stay as they are
+        return data
+    return data.rstrip() if data else None
+
+
+def cmd_result(returncode, stdout=None, stderr=None):
+    """
+    Shape the result of a command: its exit code and the output with
+    trailing whitespace stripped, None if there was none
+    """
+    return {
+        'returncode': returncode,
+        'stdout': _output(stdout),
+        'stderr': _output(stderr),
+    }
+
+
+def read_output(out_fd, err_fd, capture=None):
     """
-    Execute command on the given shell
+    Read stdout and stderr of a command until EOF, without deadlocking on
+    either, and return them as shaped by the capture policy
+    """
+    policy = capture or Capture()
+    sinks = {out_fd: _Sink(policy), err_fd: _Sink(policy)}
+    with selectors.DefaultSelector() as sel:
+        for fd in sinks:
+            sel.register(fd, selectors.EVENT_READ)
+        while sel.get_map():
+            for key, _ in sel.select():
+                chunk = os.read(key.fd, STREAM_CHUNK)
+                if chunk:
+                    sinks[key.fd].write(chunk)
+                else:
+                    sel.unregister(key.fd)
+    return sinks[out_fd].value(), sinks[err_fd].value()
+
+
+def run_cmd(cmd, is_shell, cwd=None, capture=None):
+    """
+    Execute command on the given shell. capture is a Capture policy for
+    commands with large output.
     """
     assert is_shell is not None, "is_shell param must exist"
 
@@ -13,6 +147,19 @@ def run_cmd(cmd, is_shell, cwd=None):
     else:
         args = shlex.split(cmd)
 
+    if capture is not None:
+        proc = subprocess.Popen(args,
+                                shell=is_shell,
+                                cwd=cwd,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                )
+        with proc.stdout, proc.stderr:
+            stdout, stderr = read_output(
+                proc.stdout.fileno(), proc.stderr.fileno(), capture
+            )
+        return cmd_result(proc.wait(), stdout, stderr)
+
     try:
         proc = subprocess.run(args,
                               shell=is_shell,
@@ -22,19 +169,137 @@ def run_cmd(cmd, is_shell, cwd=None):
                               universal_newlines=True
                               )
 
-        cmd_output = {
-            'returncode': proc.returncode,
-            'stdout': (proc.stdout.rstrip()
-                       if proc.stdout else None),
-            'stderr': (proc.stderr.rstrip()
-                       if proc.stderr else None
-                       )
-        }
-        return cmd_output
+        return cmd_result(proc.returncode, proc.stdout, proc.stderr)
     except OSError as e:
         raise e
 
 
+class Stream:
+    """
+    Output of a running command, iterated as ("stdout" or "stderr", data)
+    as it arrives. data is a text line or, with lines=False, a chunk of
+    bytes. A line longer than max_line is handed out in pieces, so memory
+    stays bounded. returncode is set once the output is exhausted.
+    """
+
+    def __init__(self, out_fd, err_fd, wait, kill, lines=True, max_line=STREAM_CHUNK):
+        self.returncode = None
+        self._done = False
+        self._fds = {out_fd: "stdout", err_fd: "stderr"}
+        self._wait = wait
+        self._kill = kill
+        self._lines = lines
+        self._max_line = max_line
+
+    def __iter__(self):
+        pending = {x: b"" for x in self._fds}
+        try:
+            with selectors.DefaultSelector() as sel:
+                for fd in self._fds:
+                    sel.register(fd, selectors.EVENT_READ)
+                while sel.get_map():
+                    for key, _ in sel.select():
+                        chunk = os.read(key.fd, STREAM_CHUNK)
+                        name = self._fds[key.fd]
+                        if not chunk:
+                            sel.unregister(key.fd)
+                            if pending[key.fd]:
+                                yield name, pending[key.fd].decode(errors="replace")
+                            continue
+                        if not self._lines:
+                            yield name, chunk
+                            continue
+                        buf = pending[key.fd] + chunk
+                        *lines, buf = buf.split(b"\n")
+                        for line in lines:
+                            yield name, line.decode(errors="replace") + "\n"
+                        while len(buf) >= self._max_line:
+                            yield name, buf[:self._max_line].decode(errors="replace")
+                            buf = buf[self._max_line:]
+                        pending[key.fd] = buf
+            self._done = True
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Release the pipes and reap the command, killing it if the output
+        was not read to the end
+        """
+        if self.returncode is not None:
+            return
+        for fd in self._fds:
+            os.close(fd)
+        self._fds = {}
+        if not self._done:
+            try:
+                self._kill(signal.SIGPIPE)
+            except ProcessLookupError:
+                pass
+        self.returncode = self._wait()
+
+
+def _shell_code(returncode):
+    """
+    128 + signal like a shell for a command killed by a signal, as
+    nsexec reports it
+    """
+    return 128 - returncode if returncode < 0 else returncode
+
+
+def stream_cmd(cmd, is_shell, cwd=None, lines=True):
+    """
+    Execute command on the given shell and stream its output
+    """
+    assert is_shell is not None, "is_shell param must exist"
+
+    if is_shell:
+        args = cmd
+    else:
+        args = shlex.split(cmd)
+
+    proc = subprocess.Popen(args,
+                            shell=is_shell,
+                            cwd=cwd,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            )
+    out_fd = os.dup(proc.stdout.fileno())
+    err_fd = os.dup(proc.stderr.fileno())
+    proc.stdout.close()
+    proc.stderr.close()
+    return Stream(out_fd, err_fd, lambda: _shell_code(proc.wait()), proc.send_signal,
+                  lines=lines)
+
+
+async def run_cmd_async(cmd, is_shell, cwd=None):
+    """
+    Execute command on the given shell without blocking the event loop
+    """
+    assert is_shell is not None, "is_shell param must exist"
+
+    if is_shell:
+        proc = await asyncio.create_subprocess_shell(
+            cmd,
+            cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    else:
+        proc = await asyncio.create_subprocess_exec(
+            *shlex.split(cmd),
+            cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    stdout, stderr = await proc.communicate()
+    return cmd_result(
+        proc.returncode,
+        stdout.decode(errors="replace"),
+        stderr.decode(errors="replace"),
+    )
+
+
 def popen(cmd, is_shell, cwd=None):
     """
     subprocess Popen function
@@ -1,14 +1,35 @@
+import bz2
+import gzip
 import logging
+import lzma
 import os
-import pipes
+import shlex
 import functools
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 
-from .cmd import run_cmd, popen
+from .cmd import run_cmd, popen, stream_cmd
 from .args import clean_kwargs
+from .rootfs import copy_in, copy_out, exists, open_root, root_accessible, sync_in
+from .checksum import hashfunc_map
+from .tar import ByteCounter, tar_stream, tree_size
+from .nsexec import DEFAULT_PATH, cmd_argv, container_env, ns_run, ns_stream, spawn, wait
 
 logger = logging.getLogger(__name__)
 
-PATH = "PATH=/bin:/usr/bin:/sbin:/usr/sbin:/opt/bin:/usr/local/bin:/usr/local/sbin"
+PATH = "PATH={}".format(DEFAULT_PATH)
+COMPRESSORS = {"gz": gzip.open, "bz2": bz2.open, "xz": lzma.open}
+
+# init system detection results by (leader PID, leader start time), the
+# least recently used go first
+INIT_CACHE_SIZE = 128
+_init_cache = OrderedDict()
+_init_lock = threading.Lock()
 
 
 def _validate(wrapped):
@@ -23,7 +44,7 @@ def _validate(wrapped):
         valid_driver = {
             "docker": ("lxc-attach", "nsenter", "docker-exec"),
             "lxc": ("lxc-attach",),
-            "nspawn": ("nsenter",),
+            "nspawn": ("nsenter", "setns"),
         }
         if container_type not in valid_driver:
             raise (
@@ -50,19 +71,10 @@ def _nsenter(pid):
     return "nsenter --target {} --mount --uts --ipc --net --pid".format(pid)
 
 
-@_validate
-def cont_run(
-    pid,
-    cmd,
-    container_type=None,
-    exec_driver=None,
-    is_shell=None,
-    keep_env=None,
-):
+def cont_cmd(pid, cmd, exec_driver=None, keep_env=None):
     """
-    Common logic function for running containers
+    Build the host command line running cmd in the container
     """
-
     if keep_env is None or isinstance(keep_env, bool):
         to_keep = []
     elif not isinstance(keep_env, (list, tuple)):
@@ -82,22 +94,67 @@ def cont_run(
                 full_cmd += "{} ".format(PATH)
         full_cmd += " ".join(
             [
-                "{}={}".format(x, pipes.quote(os.environ[x]))
+                "{}={}".format(x, shlex.quote(os.environ[x]))
                 for x in to_keep
                 if x in os.environ
             ]
         )
         full_cmd += " {}".format(cmd)
+    else:
+        raise Exception("no valid exec_driver")
+
+    return full_cmd
 
+
+@_validate
+def cont_run(
+    pid,
+    cmd,
+    container_type=None,
+    exec_driver=None,
+    is_shell=None,
+    keep_env=None,
+    capture=None,
+):
+    """
+    Common logic function for running containers
+    """
+    if exec_driver == "setns":
+        return ns_run(pid, cmd_argv(cmd, is_shell),
+                      env=container_env(keep_env), capture=capture)
+
+    full_cmd = cont_cmd(pid, cmd, exec_driver=exec_driver, keep_env=keep_env)
     proc = run_cmd(
         full_cmd,
         is_shell=is_shell,
-        cwd=None
+        cwd=None,
+        capture=capture,
     )
 
     return proc
 
 
+@_validate
+def cont_stream(
+    pid,
+    cmd,
+    container_type=None,
+    exec_driver=None,
+    is_shell=None,
+    keep_env=None,
+    lines=True,
+):
+    """
+    Common logic function for streaming command output from containers
+    """
+    if exec_driver == "setns":
+        return ns_stream(pid, cmd_argv(cmd, is_shell),
+                         env=container_env(keep_env), lines=lines)
+
+    full_cmd = cont_cmd(pid, cmd, exec_driver=exec_driver, keep_env=keep_env)
+    return stream_cmd(full_cmd, is_shell=is_shell, lines=lines)
+
+
 @_validate
 def cont_cpt(
         pid,
@@ -126,6 +183,11 @@ def cont_cpt(
 
     if not os.path.isabs(dest):
         raise Exception("Destination path must be absolute")
+
+    # straight through /proc/<pid>/root, no process in the container
+    if root_accessible(pid):
+        return copy_in(pid, source, dest, overwrite=overwrite, makedirs=makedirs)
+
     if (
         cont_run(pid, "test -d {}".format(dest),
                  container_type=container_type,
@@ -180,6 +242,416 @@ def cont_cpt(
             raise Exception("Failed copying the file!")
         else:
             return "Copy command completed!"
+    elif exec_driver == "setns":
+        with open(source, "rb") as f:
+            cmd_exec = ns_run(pid, ["/bin/sh", "-c", 'cat > "$1"', "sh", dest],
+                              env=container_env(), stdin=f.fileno())
+        if cmd_exec["returncode"] != 0:
+            raise Exception("Failed copying the file!")
+        else:
+            return "Copy command completed!"
+
+
+def human_size(size):
+    """
+    Format a byte count for people
+    """
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "TiB"
+    return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(int(size))
+
+
+def _copied(files, size, started):
+    """
+    Summary line of a copy
+    """
+    elapsed = max(time.monotonic() - started, 0.001)
+    what = human_size(size)
+    if files is not None:
+        what = "{} files ({})".format(files, what)
+    return "Copied {} in {:.2f}s, {}/s".format(what, elapsed, human_size(size / elapsed))
+
+
+def _cont_pipe(pid, argv, exec_driver, errors, to_container=True):
+    """
+    Start argv in a container with a pipe as its stdin, or as its stdout
+    if not to_container. Returns our end of the pipe as a file object and
+    a function waiting for the command. Everything else the command
+    prints goes to the errors file.
+    """
+    if exec_driver == "setns":
+        read_fd, write_fd = os.pipe()
+        theirs, ours = (read_fd, write_fd) if to_container else (write_fd, read_fd)
+        try:
+            child = spawn(pid, argv, env=container_env(),
+                          stdin=theirs if to_container else None,
+                          stdout=errors.fileno() if to_container else theirs,
+                          stderr=errors.fileno())
+        except BaseException:
+            os.close(ours)
+            raise
+        finally:
+            os.close(theirs)
+        # tarfile buffers, a second buffer would only copy
+        return (os.fdopen(ours, "wb" if to_container else "rb", buffering=0),
+                functools.partial(wait, child))
+
+    full_cmd = "{} env -i {} {}".format(
+        _nsenter(pid), PATH, " ".join(shlex.quote(x) for x in argv))
+    proc = subprocess.Popen(
+        full_cmd,
+        shell=True,
+        stdin=subprocess.PIPE if to_container else subprocess.DEVNULL,
+        stdout=errors if to_container else subprocess.PIPE,
+        stderr=errors,
+        bufsize=0,
+    )
+    return (proc.stdin if to_container else proc.stdout), proc.wait
+
+
+def _cont_existing(pid, paths, container_type=None, exec_driver=None):
+    """
+    Return the paths which exist in the container
+    """
+    if root_accessible(pid):
+        root = open_root(pid)
+        try:
+            return [x for x in paths if exists(root, x)]
+        finally:
+            os.close(root)
+    script = 'for p in "$@"; do test -e "$p" && echo "$p"; done; true'
+    ret = cont_run(
+        pid,
+        "/bin/sh -c {} sh {}".format(
+            shlex.quote(script), " ".join(shlex.quote(x) for x in paths)
+        ),
+        container_type=container_type,
+        exec_driver=exec_driver,
+        is_shell=True,
+    )
+    return (ret["stdout"] or "").splitlines()
+
+
+@_validate
+def cont_cpt_tree(
+        pid,
+        sources,
+        dest,
+        state,
+        container_type=None,
+        exec_driver=None,
+        overwrite=False,
+        makedirs=False,
+        progress=None,
+):
+    """
+    Copy files and directory trees into the dest directory of a container
+    as one tar stream, extracted by a single tar run in the container
+    """
+    if state != "running":
+        raise Exception("Container is not running")
+
+    for source in sources:
+        if not os.path.isabs(source):
+            raise Exception("Source path must be absolute")
+        elif not os.path.lexists(source):
+            raise Exception("Source file {} does not exist".format(source))
+    if not os.path.isabs(dest):
+        raise Exception("Destination path must be absolute")
+
+    if not overwrite:
+        targets = [
+            os.path.join(dest, os.path.basename(x.rstrip("/"))) for x in sources
+        ]
+        existing = _cont_existing(pid, targets, container_type, exec_driver)
+        if existing:
+            raise Exception(
+                "Destination path {} already exists. Use overwrite=True to "
+                "overwrite it".format(existing[0])
+            )
+
+    script = 'cd "$1" && exec tar -xpf -'
+    if makedirs:
+        script = 'mkdir -p "$1" && ' + script
+    files, total = tree_size(sources)
+    started = time.monotonic()
+    with tempfile.TemporaryFile() as errors:
+        stdin, wait_child = _cont_pipe(
+            pid, ["/bin/sh", "-c", script, "sh", dest], exec_driver, errors
+        )
+        try:
+            with stdin:
+                size = tar_stream(sources, stdin, progress=progress, total=total)
+        except BrokenPipeError:
+            # tar in the container gave up, its errors tell why
+            size = None
+        finally:
+            returncode = wait_child()
+        if returncode != 0 or size is None:
+            errors.seek(0)
+            msg = errors.read().decode(errors="replace").strip()
+            raise Exception(
+                "Failed copying the file/s{}".format(": " + msg if msg else "")
+            )
+
+    return _copied(files, size, started)
+
+
+def _inside(path):
+    """
+    Return true if the relative archive path stays below its first component
+    """
+    return not os.path.isabs(path) and os.path.normpath(path).split("/")[0] not in ("..", ".")
+
+
+def _check_member(member):
+    """
+    Refuse members and links leaving the tree and device files, and drop
+    setuid, setgid and group/other write bits. tarfile's "tar" filter
+    does not look at links and is missing from older Pythons.
+    """
+    if not _inside(member.name) or ".." in member.name.split("/"):
+        raise tarfile.TarError("{}: path outside of the tree".format(member.name))
+    if member.issym():
+        link = os.path.join(os.path.dirname(member.name), member.linkname)
+        if os.path.isabs(member.linkname) or not _inside(link):
+            raise tarfile.TarError("{}: link outside of the tree".format(member.name))
+    elif member.islnk():
+        if not _inside(member.linkname) or ".." in member.linkname.split("/"):
+            raise tarfile.TarError("{}: link outside of the tree".format(member.name))
+    elif member.isdev():
+        raise tarfile.TarError("{}: special file".format(member.name))
+    member.mode &= 0o755
+
+
+def _extract_stream(fileobj, target):
+    """
+    Extract a tar stream holding one tree to the host path target. The
+    archive comes from the container, so it is not trusted.
+    """
+    files = size = 0
+    kwargs = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+    top = os.path.basename(target)
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+        for member in tar:
+            _check_member(member)
+            # the archive holds the source under its own name
+            rest = member.name.split("/", 1)[1:]
+            member.name = "/".join([top] + rest)
+            if member.islnk():
+                rest = member.linkname.split("/", 1)[1:]
+                member.linkname = "/".join([top] + rest)
+            try:
+                tar.extract(member, os.path.dirname(target), numeric_owner=True, **kwargs)
+            except KeyError:
+                # a hard link to a member not in the archive
+                raise tarfile.TarError("{}: missing link target".format(member.name))
+            files += 1
+            if member.isfile():
+                size += member.size
+    return files, size
+
+
+def _cpf_tar(pid, source, target, exec_driver, compress=None, progress=None):
+    """
+    Stream source out of a container as a tar archive made in it
+    """
+    parent, name = os.path.split(source.rstrip("/"))
+    argv = ["tar", "-cf", "-", "-C", parent or "/", name]
+    error = None
+    with tempfile.TemporaryFile() as errors:
+        stdout, wait_child = _cont_pipe(pid, argv, exec_driver, errors, to_container=False)
+        reader = ByteCounter(stdout, progress)
+        try:
+            with stdout:
+                if compress:
+                    with COMPRESSORS[compress](target, "wb") as f:
+                        shutil.copyfileobj(reader, f, 1 << 20)
+                    ret = None, reader.bytes
+                else:
+                    ret = _extract_stream(reader, target)
+        except (OSError, tarfile.TarError) as exc:
+            error = exc
+        finally:
+            returncode = wait_child()
+        if returncode != 0 or error is not None:
+            errors.seek(0)
+            msg = errors.read().decode(errors="replace").strip() or error
+            raise Exception(
+                "Failed copying the file/s{}".format(": {}".format(msg) if msg else "")
+            )
+    return ret
+
+
+@_validate
+def cont_cpf(
+        pid,
+        source,
+        dest,
+        state,
+        container_type=None,
+        exec_driver=None,
+        overwrite=False,
+        compress=None,
+        progress=None,
+):
+    """
+    Common logic copying files out of containers
+    """
+    if state != "running":
+        raise Exception("Container is not running")
+
+    if not os.path.isabs(source):
+        raise Exception("Source path must be absolute")
+    source_name = os.path.basename(source.rstrip("/"))
+    if not source_name:
+        raise Exception("Source must not be the container root")
+    if compress is not None and compress not in COMPRESSORS:
+        raise Exception(
+            "Invalid compression '{}'. Valid types are: {}".format(
+                compress, ", ".join(sorted(COMPRESSORS))
+            )
+        )
+
+    if not os.path.isabs(dest):
+        raise Exception("Destination path must be absolute")
+    target = dest
+    if os.path.isdir(dest):
+        target = os.path.join(
+            dest, source_name + (".tar." + compress if compress else "")
+        )
+    elif not os.path.isdir(os.path.dirname(dest)):
+        raise Exception("Directory {} does not exist".format(os.path.dirname(dest)))
+    if os.path.lexists(target) and not overwrite:
+        raise Exception(
+            "Destination path {} already exists. Use overwrite=True to "
+            "overwrite it".format(target)
+        )
+
+    started = time.monotonic()
+    # straight through /proc/<pid>/root, no process in the container
+    if root_accessible(pid):
+        try:
+            files, size = copy_out(pid, source, target, compress=compress,
+                                   progress=progress)
+        except FileNotFoundError:
+            raise Exception("Source file {} does not exist in container".format(source))
+        except OSError as exc:
+            raise Exception("Failed copying the file/s: {}".format(exc))
+    else:
+        files, size = _cpf_tar(pid, source, target, exec_driver,
+                               compress=compress, progress=progress)
+    return _copied(files, size, started)
+
+
+@_validate
+def cont_sync(
+        pid,
+        source,
+        dest,
+        state,
+        container_type=None,
+        exec_driver=None,
+        checksum=None,
+        delete=False,
+        progress=None,
+):
+    """
+    Bring the dest directory of a container up to date with the host
+    directory source, copying only new and changed files
+    """
+    if state != "running":
+        raise Exception("Container is not running")
+
+    if not os.path.isabs(source):
+        raise Exception("Source path must be absolute")
+    elif not os.path.isdir(source):
+        raise Exception("Source directory {} does not exist".format(source))
+    if not os.path.isabs(dest):
+        raise Exception("Destination path must be absolute")
+    if checksum is not None and checksum not in hashfunc_map:
+        raise Exception(
+            "Invalid checksum '{}'. Valid types are: {}".format(
+                checksum, ", ".join(sorted(hashfunc_map))
+            )
+        )
+
+    if not root_accessible(pid):
+        # without the container root there is nothing to compare with
+        if delete or checksum is not None:
+            raise Exception("Unable to access the container root for a delta sync")
+        logger.warning("Container root not accessible, copying the whole tree")
+        sources = [os.path.join(source, x) for x in sorted(os.listdir(source))]
+        if not sources:
+            return "Nothing to copy"
+        return cont_cpt_tree(
+            pid,
+            sources,
+            dest,
+            state,
+            container_type=container_type,
+            exec_driver=exec_driver,
+            overwrite=True,
+            makedirs=True,
+            progress=progress,
+        )
+
+    try:
+        stats = sync_in(pid, source, dest, checksum=checksum, delete=delete,
+                        progress=progress)
+    except NotADirectoryError:
+        raise Exception("Destination path {} is not a directory".format(dest))
+    except OSError as exc:
+        raise Exception("Failed syncing the file/s: {}".format(exc))
+    return "Synced {} files ({}), {} unchanged ({} saved), {} deleted in {}".format(
+        stats["transferred"],
+        human_size(stats["transferred_bytes"]),
+        stats["unchanged"],
+        human_size(stats["saved_bytes"]),
+        stats["deleted"],
+        stats["time"],
+    )
+
+
+def _proc_key(pid):
+    """
+    Return a key identifying a process across PID reuse
+    """
+    try:
+        with open("/proc/{}/stat".format(pid), "r") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the command name may contain spaces, fields restart after ')'
+    try:
+        return pid, int(stat.rsplit(")", 1)[1].split()[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def proc_init(pid):
+    """
+    Detect systemd in a container from the host side through /proc,
+    without entering its namespaces. None if /proc is not accessible.
+    """
+    try:
+        with open("/proc/{}/comm".format(pid), "r") as f:
+            if f.read().strip() == "systemd":
+                return True
+    except OSError:
+        return None
+    try:
+        os.stat("/proc/{}/root/run/systemd/system".format(pid))
+        return True
+    except FileNotFoundError:
+        return False
+    except OSError:
+        # no access to the container root, let nsenter decide
+        return None
 
 
 @_validate
@@ -197,6 +669,20 @@ def con_init(
     if state != "running":
         raise Exception("Container is not running")
 
+    key = _proc_key(pid)
+    with _init_lock:
+        if key is not None and key in _init_cache:
+            _init_cache.move_to_end(key)
+            return _init_cache[key]
+    ret = proc_init(pid)
+    if ret is not None:
+        if key is not None:
+            with _init_lock:
+                _init_cache[key] = ret
+                if len(_init_cache) > INIT_CACHE_SIZE:
+                    _init_cache.popitem(last=False)
+        return ret
+
     cmd = "stat /run/systemd/system"
 
     if (
@@ -229,5 +715,7 @@ def login_shell(
         shell_cmd = "/bin/sh -l"
         full_cmd = "{} env -i {}".format(_nsenter(pid), shell_cmd)
         popen(full_cmd, is_shell=is_shell)
+    elif exec_driver == "setns":
+        wait(spawn(pid, ["/bin/sh", "-l"], env=container_env()))
     else:
         raise Exception("no valid exec_driver")
@@ -0,0 +1,348 @@
+import logging
+import os
+import socket
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_BUS_ADDRESS = "unix:path=/var/run/dbus/system_bus_socket"
+
+METHOD_CALL = 1
+METHOD_RETURN = 2
+ERROR = 3
+SIGNAL = 4
+
+NO_REPLY_EXPECTED = 0x1
+
+# header field codes
+_F_PATH = 1
+_F_INTERFACE = 2
+_F_MEMBER = 3
+_F_ERROR_NAME = 4
+_F_REPLY_SERIAL = 5
+_F_DESTINATION = 6
+_F_SIGNATURE = 8
+
+_fixed = {
+    "y": ("B", 1),
+    "b": ("I", 4),
+    "n": ("h", 2),
+    "q": ("H", 2),
+    "i": ("i", 4),
+    "u": ("I", 4),
+    "x": ("q", 8),
+    "t": ("Q", 8),
+    "d": ("d", 8),
+    "h": ("I", 4),
+}
+
+_align_of = {"s": 4, "o": 4, "g": 1, "a": 4, "(": 8, "{": 8, "v": 1}
+for _k, _v in _fixed.items():
+    _align_of[_k] = _v[1]
+
+
+class DBusError(Exception):
+    """
+    Error reply received from the bus
+    """
+
+    def __init__(self, name, message=""):
+        self.name = name
+        self.message = message
+        super().__init__("{}: {}".format(name, message))
+
+
+def split_signature(sig):
+    """
+    Split a signature into its single complete types
+    """
+    ret = []
+    idx = 0
+    while idx < len(sig):
+        end = _type_end(sig, idx)
+        ret.append(sig[idx:end])
+        idx = end
+    return ret
+
+
+def _type_end(sig, idx):
+    """
+    Return the index just past the complete type starting at idx
+    """
+    c = sig[idx]
+    if c == "a":
+        return _type_end(sig, idx + 1)
+    if c in "({":
+        close = ")" if c == "(" else "}"
+        depth = 0
+        for pos in range(idx, len(sig)):
+            if sig[pos] == c:
+                depth += 1
+            elif sig[pos] == close:
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+        raise ValueError("Unbalanced signature '{}'".format(sig))
+    if c in _align_of:
+        return idx + 1
+    raise ValueError("Unsupported signature '{}'".format(sig))
+
+
+class _Writer:
+    """
+    Marshal values in little endian byte order
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def pad(self, n):
+        self.buf.extend(b"\0" * (-len(self.buf) % n))
+
+    def put(self, sig, value):
+        c = sig[0]
+        if c in _fixed:
+            fmt, size = _fixed[c]
+            self.pad(size)
+            self.buf.extend(struct.pack("<" + fmt, value))
+        elif c in "so":
+            data = value.encode()
+            self.pad(4)
+            self.buf.extend(struct.pack("<I", len(data)) + data + b"\0")
+        elif c == "g":
+            data = value.encode()
+            self.buf.extend(struct.pack("<B", len(data)) + data + b"\0")
+        elif c == "v":
+            vsig, vvalue = value
+            self.put("g", vsig)
+            self.put(vsig, vvalue)
+        elif c == "a":
+            self.pad(4)
+            len_pos = len(self.buf)
+            self.buf.extend(b"\0\0\0\0")
+            elem = sig[1:]
+            self.pad(_align_of[elem[0]])
+            start = len(self.buf)
+            if elem[0] == "{":
+                key_sig, val_sig = split_signature(elem[1:-1])
+                for k, v in value.items():
+                    self.pad(8)
+                    self.put(key_sig, k)
+                    self.put(val_sig, v)
+            elif elem == "y":
+                self.buf.extend(bytes(value))
+            else:
+                for v in value:
+                    self.put(elem, v)
+            struct.pack_into("<I", self.buf, len_pos, len(self.buf) - start)
+        elif c == "(":
+            self.pad(8)
+            for s, v in zip(split_signature(sig[1:-1]), value):
+                self.put(s, v)
+        else:
+            raise ValueError("Unsupported signature '{}'".format(sig))
+
+
+class _Reader:
+    """
+    Unmarshal values from a message buffer
+    """
+
+    def __init__(self, data, endian, offset=0):
+        self.data = data
+        self.endian = endian
+        self.pos = offset
+
+    def align(self, n):
+        self.pos += -self.pos % n
+
+    def unpack(self, fmt, size):
+        value = struct.unpack_from(self.endian + fmt, self.data, self.pos)[0]
+        self.pos += size
+        return value
+
+    def get(self, sig):
+        c = sig[0]
+        if c in _fixed:
+            fmt, size = _fixed[c]
+            self.align(size)
+            value = self.unpack(fmt, size)
+            return bool(value) if c == "b" else value
+        if c in "so":
+            self.align(4)
+            length = self.unpack("I", 4)
+            value = self.data[self.pos:self.pos + length].decode(errors="replace")
+            self.pos += length + 1
+            return value
+        if c == "g":
+            length = self.unpack("B", 1)
+            value = self.data[self.pos:self.pos + length].decode()
+            self.pos += length + 1
+            return value
+        if c == "v":
+            return self.get(self.get("g"))
+        if c == "a":
+            self.align(4)
+            length = self.unpack("I", 4)
+            elem = sig[1:]
+            self.align(_align_of[elem[0]])
+            end = self.pos + length
+            if elem == "y":
+                value = bytes(self.data[self.pos:end])
+                self.pos = end
+                return value
+            if elem[0] == "{":
+                key_sig, val_sig = split_signature(elem[1:-1])
+                ret = {}
+                while self.pos < end:
+                    self.align(8)
+                    k = self.get(key_sig)
+                    ret[k] = self.get(val_sig)
+                return ret
+            ret = []
+            while self.pos < end:
+                ret.append(self.get(elem))
+            return ret
+        if c == "(":
+            self.align(8)
+            return tuple(self.get(s) for s in split_signature(sig[1:-1]))
+        raise ValueError("Unsupported signature '{}'".format(sig))
+
+
+def _parse_address(address):
+    """
+    Return the socket address of the first usable unix transport
+    """
+    for part in address.split(";"):
+        transport, _, params = part.partition(":")
+        if transport != "unix":
+            continue
+        opts = dict(x.split("=", 1) for x in params.split(",") if "=" in x)
+        if "path" in opts:
+            return opts["path"]
+        if "abstract" in opts:
+            return "\0" + opts["abstract"]
+    raise ValueError("No supported transport in bus address '{}'".format(address))
+
+
+class Connection:
+    """
+    Minimal blocking D-Bus client connection
+    """
+
+    def __init__(self, address=None, timeout=25):
+        if address is None:
+            address = os.environ.get("DBUS_SYSTEM_BUS_ADDRESS", SYSTEM_BUS_ADDRESS)
+        self.address = address
+        self._serial = 0
+        self._lock = threading.Lock()
+        self._rbuf = bytearray()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(_parse_address(address))
+            self._auth()
+            self.unique_name = self.call(
+                "org.freedesktop.DBus",
+                "/org/freedesktop/DBus",
+                "org.freedesktop.DBus",
+                "Hello",
+            )[0]
+        except Exception:
+            self.sock.close()
+            raise
+
+    def _auth(self):
+        """
+        SASL EXTERNAL authentication with our uid
+        """
+        uid = str(os.geteuid()).encode().hex()
+        self.sock.sendall(b"\0AUTH EXTERNAL " + uid.encode() + b"\r\n")
+        line = self._readline()
+        if not line.startswith(b"OK "):
+            raise ConnectionError("D-Bus authentication failed: {}".format(line))
+        self.sock.sendall(b"BEGIN\r\n")
+
+    def _readline(self):
+        while b"\r\n" not in self._rbuf:
+            self._fill()
+        line, _, rest = bytes(self._rbuf).partition(b"\r\n")
+        self._rbuf = bytearray(rest)
+        return line
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("D-Bus connection closed")
+        self._rbuf.extend(data)
+
+    def _read_exact(self, n):
+        while len(self._rbuf) < n:
+            self._fill()
+        data = bytes(self._rbuf[:n])
+        del self._rbuf[:n]
+        return data
+
+    def close(self):
+        self.sock.close()
+
+    def _send(self, msg_type, fields, signature, args, flags=0):
+        self._serial += 1
+        body = _Writer()
+        if signature:
+            for s, v in zip(split_signature(signature), args):
+                body.put(s, v)
+            fields.append((_F_SIGNATURE, ("g", signature)))
+        header = _Writer()
+        header.put("y", ord("l"))
+        header.put("y", msg_type)
+        header.put("y", flags)
+        header.put("y", 1)
+        header.put("u", len(body.buf))
+        header.put("u", self._serial)
+        header.put("a(yv)", fields)
+        header.pad(8)
+        self.sock.sendall(bytes(header.buf) + bytes(body.buf))
+        return self._serial
+
+    def _recv(self):
+        """
+        Read one message and return (type, fields, body values)
+        """
+        fixed = self._read_exact(16)
+        endian = "<" if fixed[0:1] == b"l" else ">"
+        msg_type = fixed[1]
+        body_len, _serial, fields_len = struct.unpack(endian + "III", fixed[4:16])
+        header_len = 16 + fields_len + (-(16 + fields_len) % 8)
+        data = fixed + self._read_exact(header_len - 16 + body_len)
+        reader = _Reader(data, endian, 12)
+        fields = dict(reader.get("a(yv)"))
+        body = []
+        signature = fields.get(_F_SIGNATURE)
+        if signature:
+            reader.pos = header_len
+            body = [reader.get(s) for s in split_signature(signature)]
+        return msg_type, fields, body
+
+    def call(self, destination, path, interface, member, signature="", *args):
+        """
+        Call a method and return the reply body as a list
+        """
+        fields = [
+            (_F_PATH, ("o", path)),
+            (_F_INTERFACE, ("s", interface)),
+            (_F_MEMBER, ("s", member)),
+            (_F_DESTINATION, ("s", destination)),
+        ]
+        with self._lock:
+            serial = self._send(METHOD_CALL, fields, signature, args)
+            while True:
+                msg_type, rfields, body = self._recv()
+                if rfields.get(_F_REPLY_SERIAL) != serial:
+                    # signals or stale replies are not interesting here
+                    continue
+                if msg_type == ERROR:
+                    message = body[0] if body and isinstance(body[0], str) else ""
+                    raise DBusError(rfields.get(_F_ERROR_NAME), message)
+                return body
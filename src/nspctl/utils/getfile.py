@@ -2,7 +2,14 @@ import logging
 import sys
 import socket
 import base64
+import json
 import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .checksum import StreamVerifier, verify_all
 
 _all_errors = [NotImplementedError, ValueError, socket.error]
 
@@ -11,15 +18,277 @@ try:
     from http.client import BadStatusLine as http_client_BadStatusLine
     from http.client import ResponseNotReady as http_client_ResponseNotReady
     from http.client import error as http_client_error
+    from http.client import IncompleteRead as http_client_IncompleteRead
 except ImportError as exc:
     sys.stderr.write("!!! CANNOT IMPORT HTTP.CLIENT: " + str(exc) + "\n")
 else:
     _all_errors.append(http_client_error)
 
+try:
+    import ssl
+    from http.client import HTTPSConnection as http_client_HTTPSConnection
+except ImportError:
+    ssl = None
+    http_client_HTTPSConnection = None
+
 _all_errors = tuple(_all_errors)
 
 logger = logging.getLogger(__name__)
 
+# response bodies are streamed through one buffer of this size
+CHUNK_SIZE = 1 << 20
+# idle keep-alive connections kept per host
+MAX_IDLE = 4
+# seconds without progress before a transfer counts as interrupted
+TIMEOUT = 60
+# interrupted downloads are resumed this many times
+RETRIES = 2
+# a download goes to <file>.part, described by the <file>.part.json sidecar
+PART_SUFFIX = ".part"
+# connections of a segmented download, and the smallest file worth it
+SEGMENTS = 4
+SEGMENT_MIN = 8 << 20
+
+if http_client_HTTPSConnection is not None:
+
+    class _HTTPSConnection(http_client_HTTPSConnection):
+        """
+        HTTPS connection resuming the last TLS session its pool saw for
+        the host, which saves a full handshake
+        """
+
+        def __init__(self, host, pool, **kwargs):
+            super().__init__(host, **kwargs)
+            self._pool = pool
+
+        def connect(self):
+            http_client_HTTPConnection.connect(self)
+            server_hostname = self._tunnel_host or self.host
+            self.sock = self._context.wrap_socket(
+                self.sock,
+                server_hostname=server_hostname,
+                session=self._pool.session(self),
+            )
+            self._pool.save_session(self, self.sock)
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections by protocol and host, shared by all fetches of
+    this module. Connections handed out by get() go back with release().
+    """
+
+    def __init__(self, max_idle=MAX_IDLE):
+        self.max_idle = max_idle
+        self._idle = {}
+        # connections handed out: (protocol, host), came from _idle
+        self._busy = {}
+        self._sessions = {}
+        self._context = None
+        self._lock = threading.Lock()
+
+    def _connect(self, protocol, host):
+        if protocol == "https":
+            # check python ssl support
+            if http_client_HTTPSConnection is None:
+                raise NotImplementedError(
+                    "python must have ssl enabled for https support"
+                )
+            if self._context is None:
+                # one context, sessions can only be resumed within it
+                self._context = ssl.create_default_context()
+            return _HTTPSConnection(host, self, context=self._context, timeout=TIMEOUT)
+        elif protocol == "http":
+            return http_client_HTTPConnection(host, timeout=TIMEOUT)
+        raise NotImplementedError("%s is not a supported protocol." % protocol)
+
+    def get(self, protocol, host, fresh=False):
+        """
+        Return an idle connection to host, or a new one
+        """
+        key = (protocol, host)
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle and not fresh:
+                conn = idle.pop()
+        reused = conn is not None
+        if conn is None:
+            conn = self._connect(protocol, host)
+        with self._lock:
+            self._busy[conn] = (key, reused)
+        return conn
+
+    def reused(self, conn):
+        """
+        Return true if conn was idle in the pool, the server may have
+        closed it since
+        """
+        with self._lock:
+            return self._busy.get(conn, (None, False))[1]
+
+    def retry(self, conn):
+        """
+        Drop a connection which failed and return a new one to the same
+        host, None if conn is not from the pool
+        """
+        with self._lock:
+            entry = self._busy.pop(conn, None)
+        conn.close()
+        if entry is None:
+            return None
+        return self.get(*entry[0], fresh=True)
+
+    def release(self, conn, reusable=True):
+        """
+        Take back a connection. It is kept for the next request to its
+        host if reusable and the last response left it open.
+        """
+        with self._lock:
+            entry = self._busy.pop(conn, None)
+            if entry is None:
+                # the caller's own connection
+                return
+            self.save_session(conn, conn.sock, locked=True)
+            idle = self._idle.setdefault(entry[0], [])
+            if reusable and conn.sock is not None and len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def session(self, conn):
+        with self._lock:
+            return self._sessions.get((conn.host, conn.port))
+
+    def save_session(self, conn, sock, locked=False):
+        """
+        Remember the TLS session of sock. TLS 1.3 sends the session
+        ticket after the handshake, so this is called again on release.
+        """
+        session = getattr(sock, "session", None)
+        if session is None:
+            return
+        if locked:
+            self._sessions[(conn.host, conn.port)] = session
+            return
+        with self._lock:
+            self._sessions[(conn.host, conn.port)] = session
+
+    def clear(self):
+        """
+        Close all idle connections
+        """
+        with self._lock:
+            conns = [x for y in self._idle.values() for x in y]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+
+connection_pool = ConnectionPool()
+
+
+class PartialDownload:
+    """
+    Journal of an unfinished download: the part file next to the target
+    and a sidecar recording the URL, the validator of the server copy and
+    the bytes received
+    """
+
+    def __init__(self, file_path, url):
+        self.path = file_path + PART_SUFFIX
+        self.sidecar = self.path + ".json"
+        self.url = url
+        self.etag = None
+        self.last_modified = None
+        self.bytes = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.sidecar, "r") as f:
+                data = json.load(f)
+            size = os.path.getsize(self.path)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get("url") != self.url:
+            return
+        self.etag = data.get("etag")
+        self.last_modified = data.get("last_modified")
+        if self.validator() is not None:
+            # writes are sequential, the file may be ahead of the sidecar
+            self.bytes = size
+
+    def validator(self):
+        """
+        Value for If-Range, weak ETags can not be used there
+        """
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+    def open(self):
+        """
+        Open the part file positioned after the data received so far
+        """
+        f = open(self.path, "r+b" if self.bytes else "wb")
+        f.seek(self.bytes)
+        f.truncate()
+        return f
+
+    def restart(self, dest):
+        """
+        The server sends the whole file, drop what we have
+        """
+        dest.seek(0)
+        dest.truncate()
+        self.bytes = 0
+
+    def save(self, response=None):
+        """
+        Write the sidecar, with the validators of response if given
+        """
+        if response is not None:
+            self.etag = response.getheader("ETag")
+            self.last_modified = response.getheader("Last-Modified")
+        tmp = self.sidecar + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "url": self.url,
+                "etag": self.etag,
+                "last_modified": self.last_modified,
+                "bytes": self.bytes,
+            }, f)
+        os.replace(tmp, self.sidecar)
+
+    def finish(self, file_path):
+        os.replace(self.path, file_path)
+        self.discard(part=False)
+
+    def discard(self, part=True):
+        for path in (self.path, self.sidecar) if part else (self.sidecar,):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def _rehash(dest, size, verifier):
+    """
+    Feed the first size bytes of dest to verifier, for a resumed download
+    """
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    dest.seek(0)
+    left = size
+    while left:
+        n = dest.readinto(view[:min(left, CHUNK_SIZE)])
+        if not n:
+            break
+        verifier.update(view[:n])
+        left -= n
+    dest.seek(size)
+
 
 def create_conn(baseurl, conn=None):
     """
@@ -73,39 +342,74 @@ def create_conn(baseurl, conn=None):
         http_headers = {'Authorization': 'Basic %s' % base64string}
 
     if not conn:
-        if protocol == "https":
-            # check python ssl support
-            try:
-                from http.client import HTTPSConnection as http_client_HTTPSConnection
-            except ImportError:
-                raise NotImplementedError(
-                    "python must have ssl enabled for https support"
-                )
-            conn = http_client_HTTPSConnection(host)
-        elif protocol == "http":
-            conn = http_client_HTTPConnection(host)
-        else:
-            raise NotImplementedError("%s is not a supported protocol." % protocol)
+        conn = connection_pool.get(protocol, host)
 
     return conn, protocol, address, http_params, http_headers
 
 
-def make_http_request(conn, address, _params={}, headers={}, dest=None):
+def _write_body(response, dest, verifier=None, offset=0, partial=None):
+    """
+    Stream a response body into dest, which already holds offset bytes.
+    Returns (rc, message): rc is 0 once the whole body is written, None
+    if the transfer broke off and may be resumed, 1 on a size mismatch.
+    """
+    length = response.getheader("Content-Length")
+    expected = verifier.expected.get("size") if verifier is not None else None
+    if expected is not None and length is not None and offset + int(length) != expected:
+        return 1, "Size mismatch: server sends {} bytes, expected {}".format(
+            offset + int(length), expected
+        )
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    try:
+        while True:
+            n = response.readinto(buf)
+            if not n:
+                # http.client ends a short body without complaining
+                if response.length:
+                    raise http_client_IncompleteRead(b"", response.length)
+                break
+            data = view[:n]
+            if verifier is not None and not verifier.update(data):
+                return 1, "Size mismatch: more than {} bytes received".format(expected)
+            dest.write(data)
+    except (OSError, http_client_error) as exc:
+        if partial is not None:
+            dest.flush()
+            partial.bytes = dest.tell()
+            partial.save()
+        return None, "Transfer interrupted: {}".format(str(exc) or type(exc).__name__)
+    # once, the page cache absorbs the writes until here
+    dest.flush()
+    os.fsync(dest.fileno())
+    return 0, None
+
+
+def _request(conn, address, headers):
     """
-    Uses the |conn| object to request the data
+    Send a GET request on conn and follow redirects. Returns the
+    connection and path of the final response, the response and None,
+    or None, None, None and an error message.
     """
     rc = 0
     response = None
     while (rc == 0) or (rc == 301) or (rc == 302):
         try:
-            if rc != 0:
-                conn = create_conn(address)[0]
+            if rc != 0 and not address.startswith("/"):
+                connection_pool.release(conn)
+                conn, _, address = create_conn(address)[:3]
             conn.request("GET", address, body=None, headers=headers)
+            response = conn.getresponse()
         except SystemExit as exc:
             raise Exception("{}".format(exc))
         except Exception as exc:
-            return None, None, "Server request failed: {}".format(exc)
-        response = conn.getresponse()
+            if connection_pool.reused(conn):
+                # the server closed the idle connection meanwhile
+                conn = connection_pool.retry(conn)
+                rc = 0
+                continue
+            connection_pool.release(conn, False)
+            return None, None, None, "Server request failed: {}".format(exc)
         rc = response.status
 
         # 301 means that the page address is wrong.
@@ -127,67 +431,309 @@ def make_http_request(conn, address, _params={}, headers={}, dest=None):
                             + str(parts[1])
                             + "\n"
                         )
-                    address = parts[1]
+                    address = parts[1].strip()
                     break
 
-    if (rc != 200) and (rc != 206):
-        return (
-            None,
-            rc,
-            "Server did not respond successfully (%s: %s)"
-            % (str(response.status), str(response.reason)),
-        )
+    return conn, address, response, None
+
+
+def make_http_request(
+    conn, address, _params={}, headers={}, dest=None, verifier=None, partial=None
+):
+    """
+    Uses the |conn| object to request the data. A checksum.StreamVerifier
+    hashes the body while it is written to dest. With a PartialDownload
+    the transfer continues where it broke off, if the server copy did not
+    change. Connections of the module pool, redirects included, go back
+    to it afterwards.
+    """
+    if partial is not None and partial.bytes:
+        headers = dict(headers)
+        headers["Range"] = "bytes={}-".format(partial.bytes)
+        headers["If-Range"] = partial.validator()
+    conn, address, response, msg = _request(conn, address, headers)
+    if response is None:
+        return None, None, msg
+    rc = response.status
+
+    try:
+        if rc == 416 and partial is not None and partial.bytes:
+            response.read()
+            partial.discard()
+            return None, None, "Partial download does not match, starting over"
+
+        if (rc != 200) and (rc != 206):
+            response.read()
+            return (
+                None,
+                rc,
+                "Server did not respond successfully (%s: %s)"
+                % (str(response.status), str(response.reason)),
+            )
+
+        if dest:
+            offset = 0
+            if partial is not None:
+                if rc == 206 and partial.bytes:
+                    offset = partial.bytes
+                    if verifier is not None:
+                        # hash state is not kept, recompute it from the part
+                        _rehash(dest, offset, verifier)
+                else:
+                    partial.restart(dest)
+                partial.save(response)
+            rc, msg = _write_body(response, dest, verifier, offset, partial)
+            if rc != 0:
+                # the rest of the body is still on the wire
+                response.close()
+                conn.close()
+                return None, rc, msg
+            if verifier is not None:
+                ok, reason = verifier.verify()
+                if not ok:
+                    return None, 1, "{}: got {}, expected {}".format(*reason)
+            return "", 0, ""
+
+        return response.read(), 0, ""
+    except BaseException:
+        conn.close()
+        raise
+    finally:
+        connection_pool.release(conn)
+
+
+def _validator(response):
+    """
+    ETag or Last-Modified of a response, for If-Range
+    """
+    etag = response.getheader("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.getheader("Last-Modified")
+
+
+def _conn_url(conn, address):
+    """
+    Absolute URL of a path requested on conn
+    """
+    protocol = "http"
+    if http_client_HTTPSConnection is not None and isinstance(conn, http_client_HTTPSConnection):
+        protocol = "https"
+    host = "[{}]".format(conn.host) if ":" in conn.host else conn.host
+    return "{}://{}:{}{}".format(protocol, host, conn.port, address)
 
-    if dest:
-        dest.write(response.read())
-        return "", 0, ""
 
-    return response.read(), 0, ""
+def _probe(baseurl):
+    """
+    Ask for the first byte of baseurl. Returns the URL after redirects,
+    the file size, the validator and the request headers if the server
+    sends ranges of it, None otherwise.
+    """
+    conn, _, address, _, headers = create_conn(baseurl)
+    conn, address, response, _ = _request(conn, address, dict(headers, Range="bytes=0-0"))
+    if response is None:
+        return None
+    reusable = False
+    try:
+        match = re.match(r"bytes 0-0/(\d+)$", response.getheader("Content-Range") or "")
+        if response.status != 206 or match is None:
+            # do not read what may be the whole file, drop the connection
+            return None
+        try:
+            response.read()
+        except (OSError, http_client_error):
+            return None
+        reusable = True
+        return _conn_url(conn, address), int(match.group(1)), _validator(response), headers
+    finally:
+        if not reusable:
+            response.close()
+            conn.close()
+        connection_pool.release(conn, reusable)
+
+
+def _fetch_segment(url, headers, fd, start, end, validator, retries=RETRIES):
+    """
+    Write bytes start to end (inclusive) of url at their offset in fd. A
+    failed attempt is retried from where it stopped. Returns None or an
+    error message.
+    """
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    offset = start
+    msg = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(attempt)
+        conn, _, address, _, _ = create_conn(url)
+        req_headers = dict(headers, Range="bytes={}-{}".format(offset, end))
+        if validator:
+            req_headers["If-Range"] = validator
+        conn, address, response, msg = _request(conn, address, req_headers)
+        if response is None:
+            continue
+        reusable = False
+        try:
+            match = re.match(r"bytes (\d+)-", response.getheader("Content-Range") or "")
+            if response.status != 206 or match is None or int(match.group(1)) != offset:
+                # a 200 means the file changed since the probe
+                return "Server did not send bytes {}-{} ({}: {})".format(
+                    offset, end, response.status, response.reason
+                )
+            try:
+                while offset <= end:
+                    n = response.readinto(view[:min(CHUNK_SIZE, end + 1 - offset)])
+                    if not n:
+                        if response.length:
+                            raise http_client_IncompleteRead(b"", response.length)
+                        break
+                    done = 0
+                    while done < n:
+                        done += os.pwrite(fd, view[done:n], offset + done)
+                    offset += n
+            except (OSError, http_client_error) as exc:
+                msg = "Transfer interrupted: {}".format(str(exc) or type(exc).__name__)
+                continue
+            if offset <= end:
+                msg = "Transfer interrupted at byte {}".format(offset)
+                continue
+            reusable = not response.length
+            return None
+        finally:
+            if not reusable:
+                response.close()
+                conn.close()
+            connection_pool.release(conn, reusable)
+    return msg
 
 
-def file_get(baseurl=None, dest=None, conn=None, filename=None):
+def _file_get_segmented(file_path, probe, expected=None, segments=SEGMENTS, retries=RETRIES):
+    """
+    Download probe[0] as segments byte ranges fetched concurrently into a
+    preallocated part file. Returns 0 on success.
+    """
+    url, total, validator, headers = probe
+    if expected is not None and expected.get("size") not in (None, total):
+        logger.error("%s: Size mismatch: server sends %d bytes, expected %d",
+                     url, total, expected["size"])
+        return 1
+
+    # ranges are not journaled, an old single stream part is of no use
+    PartialDownload(file_path, url).discard()
+    part = file_path + PART_SUFFIX
+    fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, total)
+        except (AttributeError, OSError):
+            # not on every file system, the sparse file still works
+            os.ftruncate(fd, total)
+        step = -(-total // segments)
+        ranges = [(x, min(x + step, total) - 1) for x in range(0, total, step)]
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            errors = [x for x in pool.map(
+                lambda r: _fetch_segment(url, headers, fd, r[0], r[1], validator, retries),
+                ranges,
+            ) if x]
+        if not errors:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if not errors and expected is not None:
+        # segments arrive out of order, so hash once at the end
+        ok, reason = verify_all(part, expected)
+        if not ok:
+            errors = ["{}: got {}, expected {}".format(*reason)]
+    if errors:
+        os.unlink(part)
+        logger.error("%s: %s", url, errors[0])
+        logger.error("Fetcher exited with a failure condition.\n")
+        return 1
+    os.replace(part, file_path)
+    logger.info("Download completed!\n")
+    return 0
+
+
+def file_get(
+    baseurl=None,
+    dest=None,
+    conn=None,
+    filename=None,
+    digests=None,
+    size=None,
+    retries=RETRIES,
+    segments=1,
+):
     """
     Takes a base url to connect to and read from.
     URL should be in the form <proto>://<site>[:port]<path>
+    digests maps checksum names to the expected hex digests and size is
+    the expected length. Both are checked while the file is downloaded, a
+    file which does not match is removed. An interrupted transfer is
+    resumed up to retries times, and its part file is kept for the next
+    call if it still fails. With segments > 1 a large file is fetched as
+    that many concurrent byte ranges if the server supports them.
     """
     if not os.path.isdir(dest):
         os.mkdir(dest)
 
     filename = str(os.path.basename(baseurl))
     file_path = os.path.join(dest, filename)
-    dest = open(file_path, 'wb')
 
-    fetch = file_get_lib(baseurl, dest, conn)
+    expected = None
+    if digests or size is not None:
+        expected = dict(digests or {})
+        if size is not None:
+            expected["size"] = size
+
+    if segments > 1 and not conn and (size is None or size >= SEGMENT_MIN):
+        probe = _probe(baseurl)
+        if probe is not None and probe[1] >= SEGMENT_MIN:
+            return _file_get_segmented(file_path, probe, expected, segments, retries)
+        logger.debug("No ranges of '%s', fetching it as one stream", filename)
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(attempt)
+        partial = PartialDownload(file_path, baseurl)
+        if partial.bytes:
+            logger.info("Resuming '%s' after %d bytes", filename, partial.bytes)
+        verifier = StreamVerifier(expected) if expected is not None else None
+        with partial.open() as f:
+            fetch = file_get_lib(baseurl, f, conn, verifier=verifier, partial=partial)
+        if fetch is not None:
+            break
 
     if fetch != os.EX_OK:
+        if fetch is not None:
+            partial.discard()
         logger.error("Fetcher exited with a failure condition.\n")
         return 1
     else:
+        partial.finish(file_path)
         logger.info("Download completed!\n")
         return 0
 
     return 1
 
 
-def file_get_lib(baseurl, dest, conn=None):
+def file_get_lib(baseurl, dest, conn=None, verifier=None, partial=None):
     """
     Takes a base url to connect to and read from.
     URL should be in the form <proto>://<site>[:port]<path>
     """
-    if not conn:
-        keepconnection = 0
-    else:
-        keepconnection = 1
-
     conn, protocol, address, params, headers = create_conn(baseurl, conn)
 
     logger.debug("Fetching '" + str(os.path.basename(address)) + "'\n")
     if protocol in ["http", "https"]:
-        data, rc, _msg = make_http_request(conn, address, params, headers, dest=dest)
+        data, rc, msg = make_http_request(
+            conn, address, params, headers, dest=dest, verifier=verifier, partial=partial
+        )
     else:
         raise TypeError("Unknown protocol. '%s'" % protocol)
 
-    if not keepconnection:
-        conn.close()
+    if rc != 0:
+        logger.error("%s: %s", baseurl, msg)
 
     return rc
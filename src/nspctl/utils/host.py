@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import tempfile
+
+from .path import which
+from .systemd import systemd_version
+
+logger = logging.getLogger(__name__)
+
+CACHE_NAME = "host.json"
+CACHE_FORMAT = 1
+BOOTSTRAP_TOOLS = ("pacstrap", "debootstrap")
+MACHINED_PATHS = (
+    "/usr/lib/systemd/systemd-machined",
+    "/lib/systemd/systemd-machined",
+)
+
+_caps = None
+
+
+def _cache_dir():
+    """
+    Return the directory the host capability cache lives in.
+    /run is cleared on reboot, so the cache never outlives the host state
+    it describes.
+    """
+    if os.geteuid() == 0:
+        return "/run/nspctl"
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "nspctl")
+    return None
+
+
+def _cache_key():
+    """
+    Return the cache key: identity of the systemctl binary and PATH.
+    A systemd upgrade replaces systemctl, which invalidates the cache.
+    """
+    systemctl = which("systemctl")
+    if systemctl is None:
+        return None
+    try:
+        st = os.stat(systemctl)
+    except OSError:
+        return None
+    return [systemctl, st.st_ino, st.st_mtime_ns, st.st_size, os.environ.get("PATH")]
+
+
+def _probe():
+    """
+    Probe the host capabilities
+    """
+    sd_version = systemd_version()
+    if sd_version is not None and sd_version >= 219:
+        roots = ["/var/lib/machines", "/var/lib/container"]
+    else:
+        roots = ["/var/lib/container"]
+
+    return {
+        "systemd_version": sd_version,
+        "machinectl": which("machinectl"),
+        "machined": any(os.path.exists(x) for x in MACHINED_PATHS),
+        "tools": {x: which(x) for x in BOOTSTRAP_TOOLS},
+        "roots": roots,
+    }
+
+
+def _load(path, key):
+    """
+    Load cached capabilities if they match the given key
+    """
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    if data.get("format") != CACHE_FORMAT or data.get("key") != key:
+        return None
+    return data.get("caps")
+
+
+def _save(path, key, caps):
+    """
+    Atomically write the capabilities cache
+    """
+    cache_dir = os.path.dirname(path)
+    try:
+        os.makedirs(cache_dir, mode=0o755, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix=".host.")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"format": CACHE_FORMAT, "key": key, "caps": caps}, f)
+        os.replace(temp_path, path)
+    except OSError as exc:
+        logger.debug("Unable to write host capability cache %s: %s", path, exc)
+
+
+def host_caps(refresh=False):
+    """
+    Return the host capabilities. Probed once per process and persisted
+    on disk until the systemctl binary changes.
+    """
+    global _caps
+    if _caps is not None and not refresh:
+        return _caps
+
+    key = _cache_key()
+    cache_dir = _cache_dir()
+    path = os.path.join(cache_dir, CACHE_NAME) if cache_dir else None
+
+    caps = None
+    if key is not None and path is not None and not refresh:
+        caps = _load(path, key)
+    if caps is None:
+        caps = _probe()
+        # never persist a failed probe
+        if key is not None and path is not None and caps["systemd_version"] is not None:
+            _save(path, key, caps)
+
+    _caps = caps
+    return _caps
+
+
+def host_systemd_version():
+    """
+    Return the cached systemd version
+    """
+    return host_caps()["systemd_version"]
+
+
+def host_roots():
+    """
+    Return the cached container image root directories
+    """
+    return host_caps()["roots"]
+
+
+def host_tool(name):
+    """
+    Return the cached path of a bootstrap tool, or None
+    """
+    path = host_caps()["tools"].get(name)
+    if path is not None and os.access(path, os.X_OK):
+        return path
+    # tool removed since the probe or not one we cache
+    return which(name)
+
+
+def has_machined():
+    """
+    Return true if systemd-machined is available on the host
+    """
+    return host_caps()["machined"]
@@ -0,0 +1,476 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+from . import machined
+from .container_resource import proc_init
+from .host import host_roots, host_systemd_version
+
+logger = logging.getLogger(__name__)
+
+SHOW_PROPERTIES = ("Name", "Class", "Leader", "State", "RootDirectory", "Timestamp")
+MACHINES_DIR = "/run/systemd/machines"
+# machined image search path, in order of precedence
+IMAGE_PATHS = (
+    "/etc/machines",
+    "/run/machines",
+    "/var/lib/machines",
+    "/usr/local/lib/machines",
+    "/usr/lib/machines",
+)
+
+
+class Image:
+    """
+    One container image and, if it is running, its machine
+    """
+
+    __slots__ = ("name", "type", "state", "leader", "init", "addresses", "details")
+
+    def __init__(self, name, img_type=None):
+        self.name = name
+        self.type = img_type
+        self.state = "stopped"
+        self.leader = None
+        # True for systemd, False for another init, None if unknown
+        self.init = None
+        self.addresses = []
+        self.details = {}
+
+    def as_dict(self):
+        ret = {"Type": self.type, "State": self.state}
+        if self.leader is not None:
+            ret["PID"] = str(self.leader)
+        if self.addresses:
+            ret["Address"] = (
+                self.addresses[0] if len(self.addresses) == 1 else list(self.addresses)
+            )
+        if self.init is not None:
+            ret["Init"] = "systemd" if self.init else "other"
+        for key, val in self.details.items():
+            ret.setdefault(key, val)
+        return ret
+
+
+class Inventory:
+    """
+    Snapshot of all images and running machines, gathered in one batch
+    """
+
+    def __init__(self, images, source=None):
+        # by name, like 'machinectl list'
+        self.images = dict(sorted(images.items()))
+        self.source = source
+        self.created = time.monotonic()
+        self._filled = set()
+
+    def __contains__(self, name):
+        return name in self.images
+
+    def get(self, name):
+        return self.images.get(name)
+
+    def names(self):
+        return list(self.images)
+
+    def running(self):
+        return [x.name for x in self.images.values() if x.state != "stopped"]
+
+    def stopped(self):
+        return sorted(x.name for x in self.images.values() if x.state == "stopped")
+
+    def as_dict(self):
+        return {x.name: x.as_dict() for x in self.images.values()}
+
+    def fill(self, names=None):
+        """
+        Complete the running machines in names, or all of them, with
+        what only info shows. Listing does not need it.
+        """
+        images = [
+            self.images[x] for x in (self.images if names is None else names)
+            if x in self.images and x not in self._filled
+            and self.images[x].leader is not None
+        ]
+        self._filled.update(x.name for x in images)
+        _detect_init(images)
+        if self.source == "fs":
+            _fill_addresses(images)
+
+    @classmethod
+    def collect(cls):
+        """
+        Gather the inventory from machined, machinectl or the image roots
+        """
+        if host_systemd_version() >= 219:
+            for source, collector in (
+                ("fs", collect_fs),
+                ("machined", _collect_machined),
+                ("machinectl", _collect_machinectl),
+            ):
+                images = collector()
+                if images is not None:
+                    return cls(images, source)
+        return cls(_collect_roots(), "roots")
+
+
+class MetaCache:
+    """
+    Container metadata (existence, state, PID, init type) by name.
+    Entries never expire unless a ttl in seconds is given.
+    """
+
+    MISS = object()
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, key):
+        with self._lock:
+            entry = self._entries.get((name, key))
+        if entry is None:
+            return self.MISS
+        value, stamp = entry
+        if self.ttl is not None and time.monotonic() - stamp > self.ttl:
+            return self.MISS
+        return value
+
+    def set(self, name, key, value):
+        with self._lock:
+            self._entries[(name, key)] = (value, time.monotonic())
+        return value
+
+    def invalidate(self, name=None):
+        """
+        Drop the entries of one container, or of all containers
+        """
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                for key in [x for x in self._entries if x[0] == name]:
+                    del self._entries[key]
+
+
+def _detect_init(images):
+    """
+    Init system of running machines, read from /proc/<leader>
+    """
+    for image in images:
+        if image.init is None:
+            image.init = proc_init(image.leader)
+
+
+def _details(props):
+    """
+    Human readable info keys from machine properties
+    """
+    ret = {}
+    since = props.get("Timestamp")
+    if isinstance(since, int) and since:
+        ret["Running Since"] = time.strftime(
+            "%a %Y-%m-%d %H:%M:%S %Z", time.localtime(since / 1000000)
+        )
+    elif since:
+        # machinectl show already formats timestamps
+        ret["Running Since"] = since
+    for key in ("Class", "Unit"):
+        if props.get(key):
+            ret[key] = props[key]
+    if props.get("RootDirectory"):
+        ret["Root"] = props["RootDirectory"]
+    ifaces = []
+    for idx in props.get("NetworkInterfaces") or []:
+        try:
+            ifaces.append(socket.if_indextoname(idx))
+        except OSError:
+            ifaces.append(str(idx))
+    if ifaces:
+        ret["Network Interface"] = ifaces[0] if len(ifaces) == 1 else ifaces
+    return ret
+
+
+def _scan_images():
+    """
+    Scan the image search path like machined does: directories and
+    subvolumes by name, raw disk images without their .raw suffix
+    """
+    images = {}
+    for path in IMAGE_PATHS:
+        try:
+            it = os.scandir(path)
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                name = entry.name
+                if name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir():
+                        # btrfs subvolumes always have inode 256
+                        img_type = "subvolume" if entry.inode() == 256 else "directory"
+                    elif entry.is_file() and name.endswith(".raw"):
+                        name = name[:-len(".raw")]
+                        img_type = "raw"
+                    else:
+                        continue
+                except OSError:
+                    continue
+                images.setdefault(name, Image(name, img_type))
+    return images
+
+
+def read_machine_file(name):
+    """
+    Parse the machined state file of a running machine into a dict.
+    Returns {} if the machine is not registered and None if the file
+    has a layout we do not understand.
+    """
+    ret = {}
+    try:
+        with open(os.path.join(MACHINES_DIR, name), "r") as f:
+            for line in f:
+                if line.startswith("#") or "=" not in line:
+                    continue
+                key, _, val = line.rstrip("\n").partition("=")
+                ret[key] = val
+    except FileNotFoundError:
+        return {}
+    except (OSError, UnicodeDecodeError):
+        return None
+    if ret.get("NAME") != name:
+        return None
+    try:
+        ret["LEADER"] = int(ret["LEADER"])
+    except (KeyError, ValueError):
+        return None
+    # machined removes the file on cleanup, a stale one has a dead leader
+    if not os.path.exists("/proc/{}".format(ret["LEADER"])):
+        return {}
+    return ret
+
+
+def _machine_file_details(data):
+    """
+    Human readable info keys from a machined state file
+    """
+    props = {
+        "Class": data.get("CLASS"),
+        "Unit": data.get("SCOPE"),
+        "RootDirectory": data.get("ROOT"),
+    }
+    try:
+        props["Timestamp"] = int(data.get("REALTIME"))
+    except (TypeError, ValueError):
+        pass
+    return _details(props)
+
+
+def collect_fs():
+    """
+    Read images and running machines straight from the file system,
+    without any subprocess or bus round trip. Addresses are not kept
+    there, see Inventory.fill(). None if the layout is not what we
+    expect, so the caller falls back to machined/machinectl.
+    """
+    if not os.path.isdir(MACHINES_DIR):
+        return None
+    images = _scan_images()
+    try:
+        it = os.scandir(MACHINES_DIR)
+    except OSError:
+        return None
+    with it:
+        for entry in it:
+            # "unit:<scope>" entries are symlinks back to the machine name
+            if ":" in entry.name or not entry.is_file(follow_symlinks=False):
+                continue
+            data = read_machine_file(entry.name)
+            if data is None:
+                logger.debug("Unexpected machine state file %s", entry.path)
+                return None
+            if not data:
+                continue
+            image = images.setdefault(entry.name, Image(entry.name))
+            image.state = data.get("STATE") or "running"
+            image.leader = data["LEADER"]
+            image.details = _machine_file_details(data)
+    return images
+
+
+def _fill_addresses(images):
+    """
+    Addresses of running machines from machined, or from a single
+    'machinectl list' without the bus
+    """
+    listed = None
+    for image in images:
+        addrs = machined.machine_addresses(image.name)
+        if addrs is None:
+            if listed is None:
+                listed = _list_machines()[1]
+            addrs = listed.get(image.name, [])
+        image.addresses = addrs
+
+
+def image_exists(name):
+    """
+    Check for a single image on the file system. Returns None if the
+    layout is not the one we know, so the caller must fall back to a full
+    inventory.
+    """
+    if not os.path.isdir(MACHINES_DIR):
+        return None
+    if not name or "/" in name or name.startswith("."):
+        return False
+    if os.path.isfile(os.path.join(MACHINES_DIR, name)):
+        return True
+    for path in IMAGE_PATHS:
+        image = os.path.join(path, name)
+        if os.path.isdir(image) or os.path.isfile(image + ".raw"):
+            return True
+    return False
+
+
+def lookup(name):
+    """
+    Return (state, leader PID) of a single machine without a full
+    inventory: the machined state file, then machined over D-Bus, then
+    'machinectl show'. Stopped machines have no leader.
+    """
+    if os.path.isdir(MACHINES_DIR):
+        data = read_machine_file(name)
+        if data is not None:
+            if not data:
+                return "stopped", None
+            return data.get("STATE") or "running", data["LEADER"]
+
+    props = machined.machine_properties(name)
+    if props is not None:
+        if not props:
+            return "stopped", None
+        return props.get("State") or "running", props.get("Leader")
+
+    ret = machined.machinectl("show -p Leader -p State {}".format(name))
+    if ret["returncode"] != 0 or not ret["stdout"]:
+        return "stopped", None
+    props = dict(x.partition("=")[::2] for x in ret["stdout"].splitlines())
+    try:
+        leader = int(props.get("Leader"))
+    except (TypeError, ValueError):
+        leader = None
+    return props.get("State") or "stopped", leader
+
+
+def _collect_machined():
+    """
+    One ListImages and ListMachines round trip plus the properties of
+    every running machine. None if machined is not on the bus.
+    """
+    img_list = machined.list_images()
+    machines = machined.list_machines()
+    if img_list is None or machines is None:
+        return None
+    images = {}
+    for entry in img_list:
+        if not entry[0].startswith("."):
+            images[entry[0]] = Image(entry[0], entry[1])
+    for entry in machines:
+        image = images.setdefault(entry[0], Image(entry[0]))
+        props = machined.machine_properties(image.name) or {}
+        image.state = props.get("State", "running")
+        image.leader = props.get("Leader")
+        image.details = _details(props)
+        image.addresses = machined.machine_addresses(image.name) or []
+    return images
+
+
+def _list_machines():
+    """
+    Names of the running machines and their addresses from
+    'machinectl list'
+    """
+    running = []
+    addresses = {}
+    name = None
+    for line in (machined.machinectl("list")["stdout"] or "").splitlines():
+        parts = line.split()
+        if not parts:
+            continue
+        if line[0].isspace():
+            # continuation line of the ADDRESSES column
+            if name is not None:
+                addresses[name].append(parts[0].rstrip("…"))
+            continue
+        name = parts[0]
+        running.append(name)
+        addresses[name] = [parts[5].rstrip("…")] if len(parts) >= 6 else []
+    return running, addresses
+
+
+def _collect_machinectl():
+    """
+    list-images, list and a single multi-machine show
+    """
+    ret = machined.machinectl("list-images")
+    if ret["returncode"] != 0:
+        return None
+    images = {}
+    for line in (ret["stdout"] or "").splitlines():
+        parts = line.split()
+        if parts:
+            images[parts[0]] = Image(parts[0], parts[1] if len(parts) > 1 else None)
+
+    running, addresses = _list_machines()
+    for name in running:
+        image = images.setdefault(name, Image(name))
+        image.state = "running"
+        image.addresses = addresses[name]
+
+    if running:
+        cmd = "show {} {}".format(
+            " ".join("-p {}".format(x) for x in SHOW_PROPERTIES),
+            " ".join(running),
+        )
+        block = {}
+        blocks = []
+        # one block of properties per machine, separated by empty lines
+        for line in (machined.machinectl(cmd)["stdout"] or "").splitlines() + [""]:
+            if not line.strip():
+                if block:
+                    blocks.append(block)
+                block = {}
+                continue
+            key, _, val = line.partition("=")
+            block[key] = val
+        for props in blocks:
+            image = images.get(props.get("Name"))
+            if image is None:
+                continue
+            image.state = props.get("State") or "running"
+            try:
+                image.leader = int(props.get("Leader"))
+            except (TypeError, ValueError):
+                pass
+            image.details = _details(props)
+    return images
+
+
+def _collect_roots():
+    """
+    systemd < 219: images are the directories of the container root
+    """
+    images = {}
+    rootdir = host_roots()[0]
+    try:
+        for dirname in os.listdir(rootdir):
+            if os.path.isdir(os.path.join(rootdir, dirname)):
+                images[dirname] = Image(dirname, "directory")
+    except OSError:
+        pass
+    return images
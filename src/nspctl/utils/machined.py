@@ -0,0 +1,256 @@
+import logging
+import signal
+import socket
+import time
+
+from .cmd import cmd_result, run_cmd, run_cmd_async
+from .dbus import Connection, DBusError
+from .host import has_machined
+
+logger = logging.getLogger(__name__)
+
+MACHINED = "org.freedesktop.machine1"
+MACHINED_PATH = "/org/freedesktop/machine1"
+MANAGER = "org.freedesktop.machine1.Manager"
+MACHINE = "org.freedesktop.machine1.Machine"
+
+SYSTEMD = "org.freedesktop.systemd1"
+SYSTEMD_PATH = "/org/freedesktop/systemd1"
+SYSTEMD_MANAGER = "org.freedesktop.systemd1.Manager"
+SYSTEMD_JOB = "org.freedesktop.systemd1.Job"
+
+# errors meaning the machine simply is not registered (i.e. not running)
+NO_MACHINE_ERRORS = (
+    "org.freedesktop.machine1.NoSuchMachine",
+    "org.freedesktop.DBus.Error.UnknownObject",
+)
+
+# errors meaning machined itself can not serve us, use machinectl instead
+UNAVAILABLE_ERRORS = (
+    "org.freedesktop.DBus.Error.ServiceUnknown",
+    "org.freedesktop.DBus.Error.NameHasNoOwner",
+    "org.freedesktop.DBus.Error.AccessDenied",
+    "org.freedesktop.DBus.Error.NoReply",
+    "org.freedesktop.DBus.Error.UnknownMethod",
+    "org.freedesktop.DBus.Error.UnknownInterface",
+)
+
+# the fallback when machined is not on the bus
+MACHINECTL = "machinectl --no-legend --no-pager"
+
+_bus = None
+_bus_failed = False
+
+
+def get_bus():
+    """
+    Return the process wide system bus connection, or None if the bus is
+    not reachable or machined is not installed. A failed connection
+    attempt is not retried.
+    """
+    global _bus, _bus_failed
+    if _bus is not None or _bus_failed:
+        return _bus
+    if not has_machined():
+        # nothing on the bus to talk to, machinectl reports the error
+        logger.debug("systemd-machined not installed, using machinectl")
+        _bus_failed = True
+        return None
+    try:
+        _bus = Connection()
+    except (OSError, ValueError, DBusError) as exc:
+        logger.debug("System bus not available, using machinectl: %s", exc)
+        _bus_failed = True
+    return _bus
+
+
+def reset_bus():
+    """
+    Close the shared connection, the next call reconnects
+    """
+    global _bus, _bus_failed
+    if _bus is not None:
+        _bus.close()
+    _bus = None
+    _bus_failed = False
+
+
+def machinectl(cmd):
+    """
+    Helper function to run machinectl
+    """
+    return run_cmd("{} {}".format(MACHINECTL, cmd), is_shell=True)
+
+
+async def machinectl_async(cmd):
+    """
+    machinectl() without blocking the event loop
+    """
+    return await run_cmd_async("{} {}".format(MACHINECTL, cmd), is_shell=True)
+
+
+def _bus_call(destination, path, interface, member, signature="", *args):
+    """
+    Call a method on the shared connection. Returns None if the bus or
+    the service is unavailable, so callers can fall back to machinectl.
+    """
+    global _bus_failed
+    bus = get_bus()
+    if bus is None:
+        return None
+    try:
+        return bus.call(destination, path, interface, member, signature, *args)
+    except OSError:
+        # the connection is broken, drop it so we fall back
+        reset_bus()
+        _bus_failed = True
+        return None
+    except DBusError as exc:
+        if exc.name in UNAVAILABLE_ERRORS:
+            logger.debug("machined not usable, using machinectl: %s", exc)
+            return None
+        raise
+
+
+def _call(member, signature="", *args):
+    """
+    Call a machined manager method
+    """
+    return _bus_call(MACHINED, MACHINED_PATH, MANAGER, member, signature, *args)
+
+
+def list_machines():
+    """
+    Return registered machines as (name, class, service, object path)
+    """
+    ret = _call("ListMachines")
+    return None if ret is None else ret[0]
+
+
+def list_images():
+    """
+    Return images as (name, type, read only, crtime, mtime, usage, object path)
+    """
+    ret = _call("ListImages")
+    return None if ret is None else ret[0]
+
+
+def machine_properties(name):
+    """
+    Return all properties of a registered machine in one round trip.
+    Returns {} if the machine is not running and None if the bus is
+    unavailable.
+    """
+    try:
+        path = _call("GetMachine", "s", name)
+        if path is None:
+            return None
+        ret = _bus_call(
+            MACHINED, path[0],
+            "org.freedesktop.DBus.Properties", "GetAll", "s", MACHINE,
+        )
+        return None if ret is None else ret[0]
+    except DBusError as exc:
+        if exc.name in NO_MACHINE_ERRORS:
+            return {}
+        raise
+
+
+def machine_addresses(name):
+    """
+    Return the IP addresses of a running machine as strings, None if
+    the bus is unavailable
+    """
+    ret = []
+    try:
+        addrs = _call("GetMachineAddresses", "s", name)
+    except DBusError:
+        return ret
+    if addrs is None:
+        return None
+    for family, raw in addrs[0]:
+        try:
+            ret.append(socket.inet_ntop(family, raw))
+        except (OSError, ValueError):
+            continue
+    return ret
+
+
+def machine_os_release(name):
+    """
+    Return the os-release fields of a running machine
+    """
+    try:
+        ret = _call("GetMachineOSRelease", "s", name)
+    except DBusError:
+        return {}
+    return ret[0] if ret else {}
+
+
+def _unit_escape(name):
+    """
+    Escape a machine name for use as a unit instance name
+    """
+    ret = ""
+    for idx, c in enumerate(name):
+        if c == "/":
+            ret += "-"
+        elif c.isalnum() and c.isascii() or c in ":_" or (c == "." and idx > 0):
+            ret += c
+        else:
+            ret += "".join("\\x{:02x}".format(b) for b in c.encode())
+    return ret
+
+
+def _wait_job(job, timeout=90):
+    """
+    Wait until a systemd job object disappears
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            ret = _bus_call(
+                SYSTEMD, job,
+                "org.freedesktop.DBus.Properties", "Get", "ss", SYSTEMD_JOB, "State",
+            )
+        except DBusError:
+            return True
+        if ret is None:
+            return False
+        time.sleep(0.02)
+    return False
+
+
+def machine_action(action, name, *args):
+    """
+    Run a machinectl verb over D-Bus. Returns a run_cmd style dict, or
+    None if the action is not supported or the bus is unavailable.
+    """
+    try:
+        if action == "start":
+            unit = "systemd-nspawn@{}.service".format(_unit_escape(name))
+            ret = _bus_call(
+                SYSTEMD, SYSTEMD_PATH, SYSTEMD_MANAGER,
+                "StartUnit", "ss", unit, "replace",
+            )
+            if ret is None:
+                return None
+            # a finished start job leaves a registered machine behind
+            ok = _wait_job(ret[0]) and bool(machine_properties(name))
+            return cmd_result(0 if ok else 1)
+        elif action == "poweroff":
+            ret = _call("KillMachine", "ssi", name, "leader", signal.SIGRTMIN + 4)
+        elif action == "reboot":
+            ret = _call("KillMachine", "ssi", name, "leader", signal.SIGINT)
+        elif action == "terminate":
+            ret = _call("TerminateMachine", "s", name)
+        elif action == "remove":
+            ret = _call("RemoveImage", "s", name)
+        elif action == "rename":
+            ret = _call("RenameImage", "ss", name, args[0])
+        else:
+            return None
+    except DBusError as exc:
+        return cmd_result(1, stderr=exc.message or exc.name)
+    # None means the bus went away, let the caller use machinectl
+    return None if ret is None else cmd_result(0)
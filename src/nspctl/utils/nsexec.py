@@ -0,0 +1,274 @@
+import ctypes
+import logging
+import os
+import shlex
+import shutil
+import signal
+import threading
+
+from .cmd import Stream, cmd_result, read_output
+
+logger = logging.getLogger(__name__)
+
+# same order nsenter uses, the mount namespace goes last
+NAMESPACES = ("ipc", "uts", "net", "pid", "mnt")
+DEFAULT_PATH = "/bin:/usr/bin:/sbin:/usr/sbin:/opt/bin:/usr/local/bin:/usr/local/sbin"
+
+CLONE_FS = 0x00000200
+
+_libc = None
+
+
+def _libc_call(func, *args):
+    """
+    Call a libc function, raising OSError on failure
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    if getattr(_libc, func)(*args) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def _setns(fd, nstype=0):
+    """
+    setns(2), from the os module on Python >= 3.12 or libc otherwise
+    """
+    if hasattr(os, "setns"):
+        return os.setns(fd, nstype)
+    _libc_call("setns", fd, nstype)
+
+
+def _unshare_fs():
+    """
+    Give the calling thread its own root and working directory, which
+    setns(2) requires to join a mount namespace
+    """
+    if hasattr(os, "unshare"):
+        return os.unshare(CLONE_FS)
+    _libc_call("unshare", CLONE_FS)
+
+
+def setns_available():
+    """
+    Return true if setns(2) can be called on this host
+    """
+    if hasattr(os, "setns") and hasattr(os, "unshare"):
+        return True
+    if not hasattr(os, "posix_spawn"):
+        return False
+    try:
+        libc = ctypes.CDLL(None)
+        return hasattr(libc, "setns") and hasattr(libc, "unshare")
+    except OSError:
+        return False
+
+
+def open_namespaces(pid):
+    """
+    Open the namespaces of a process, returns a list of file descriptors
+    """
+    fds = []
+    try:
+        for ns in NAMESPACES:
+            fds.append(os.open("/proc/{}/ns/{}".format(pid, ns), os.O_RDONLY | os.O_CLOEXEC))
+    except OSError:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return fds
+
+
+def container_env(keep_env=None):
+    """
+    Build the environment of a command run in a container
+    """
+    if keep_env is True:
+        return dict(os.environ)
+    if keep_env is None or isinstance(keep_env, bool):
+        to_keep = []
+    elif not isinstance(keep_env, (list, tuple)):
+        try:
+            to_keep = keep_env.split(",")
+        except AttributeError:
+            logger.warning("Invalid keep_env value, ignoring")
+            to_keep = []
+    else:
+        to_keep = keep_env
+
+    env = {"PATH": DEFAULT_PATH}
+    env.update({x: os.environ[x] for x in to_keep if x in os.environ})
+    return env
+
+
+def _exit_code(status):
+    """
+    Exit code of a wait status, 128 + signal like a shell for signals
+    """
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def cmd_argv(cmd, is_shell):
+    """
+    Argument vector of a command line, there is no host shell to split it
+    """
+    if is_shell:
+        return ["/bin/sh", "-c", cmd]
+    return shlex.split(cmd)
+
+
+def enter(ns_fds):
+    """
+    Join the namespaces in the calling thread. Our root and working
+    directory must not be shared for the mount namespace.
+    """
+    _unshare_fs()
+    for fd in ns_fds:
+        _setns(fd)
+    os.chdir("/")
+
+
+def exec_here(argv, env, stdin=None, stdout=None, stderr=None):
+    """
+    Start argv with posix_spawn() from the current namespaces. Returns
+    (pid, None) or (None, (returncode, message)).
+    """
+    # resolved inside the container's mount namespace
+    path = shutil.which(argv[0], path=env.get("PATH", DEFAULT_PATH))
+    if path is None:
+        return None, (127, "{}: command not found".format(argv[0]))
+    actions = [
+        (os.POSIX_SPAWN_DUP2, fd, target)
+        for fd, target in ((stdin, 0), (stdout, 1), (stderr, 2))
+        if fd is not None
+    ]
+    try:
+        pid = os.posix_spawn(
+            path, argv, env, file_actions=actions, setsigdef=(signal.SIGPIPE,)
+        )
+    except OSError as exc:
+        return None, (126, "{}: {}".format(argv[0], exc.strerror))
+    return pid, None
+
+
+def _spawn(ns_fds, argv, env, stdin, stdout, stderr):
+    """
+    Join the namespaces from a throwaway thread and start the command
+    from there. posix_spawn() does not copy our address space like
+    fork() does, and the thread is never reused.
+    """
+    result = {}
+
+    def run():
+        try:
+            enter(ns_fds)
+        except OSError as exc:
+            result["ret"] = None, (1, "nspctl: unable to enter container: {}".format(exc))
+            return
+        result["ret"] = exec_here(argv, env, stdin, stdout, stderr)
+
+    # namespaces are per thread, this one is discarded afterwards
+    thread = threading.Thread(target=run, name="nspctl-setns", daemon=True)
+    thread.start()
+    thread.join()
+    return result["ret"]
+
+
+def spawn(pid, argv, env=None, stdin=None, stdout=None, stderr=None):
+    """
+    Start argv inside the namespaces of pid. stdin, stdout and stderr are
+    file descriptors, None inherits ours. Returns the PID of the command.
+    """
+    if env is None:
+        env = container_env()
+    try:
+        ns_fds = open_namespaces(pid)
+    except OSError as exc:
+        raise Exception("Unable to enter container: {}".format(exc))
+    try:
+        child, error = _spawn(ns_fds, argv, env, stdin, stdout, stderr)
+    finally:
+        for fd in ns_fds:
+            os.close(fd)
+    if error is not None:
+        raise Exception(error[1])
+    return child
+
+
+def wait(child):
+    """
+    Wait for a process started with spawn() and return its exit code
+    """
+    while True:
+        try:
+            _, status = os.waitpid(child, 0)
+            return _exit_code(status)
+        except InterruptedError:
+            continue
+
+
+def collect(start, policy=None):
+    """
+    Run a command and collect its output. start(stdout, stderr) starts
+    it on the given pipe ends and returns (pid, error) like exec_here().
+    policy is a utils.cmd.Capture.
+    """
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    try:
+        try:
+            child, error = start(out_w, err_w)
+        finally:
+            os.close(out_w)
+            os.close(err_w)
+        if error is not None:
+            return cmd_result(error[0], stderr=error[1])
+        stdout, stderr = read_output(out_r, err_r, policy)
+    finally:
+        os.close(out_r)
+        os.close(err_r)
+    return {"returncode": wait(child), "stdout": stdout, "stderr": stderr}
+
+
+def ns_run(pid, argv, env=None, stdin=None, capture=None):
+    """
+    Run argv inside the namespaces of pid and capture its output.
+    Returns the same dict as utils.cmd.run_cmd.
+    """
+    if env is None:
+        env = container_env()
+    try:
+        ns_fds = open_namespaces(pid)
+    except OSError as exc:
+        return cmd_result(1, stderr="nspctl: unable to enter container: {}".format(exc))
+    try:
+        return collect(
+            lambda out, err: _spawn(ns_fds, argv, env, stdin, out, err), capture
+        )
+    finally:
+        for fd in ns_fds:
+            os.close(fd)
+
+
+def ns_stream(pid, argv, env=None, lines=True):
+    """
+    Start argv inside the namespaces of pid and stream its output,
+    see utils.cmd.Stream
+    """
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    try:
+        child = spawn(pid, argv, env=env, stdout=out_w, stderr=err_w)
+    except BaseException:
+        os.close(out_r)
+        os.close(err_r)
+        raise
+    finally:
+        os.close(out_w)
+        os.close(err_w)
+    return Stream(
+        out_r, err_r, lambda: wait(child), lambda sig: os.kill(child, sig), lines=lines
+    )
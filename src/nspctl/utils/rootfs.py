@@ -0,0 +1,591 @@
+import errno
+import logging
+import os
+import stat
+import tarfile
+import time
+import uuid
+
+from .checksum import hashfunc_map
+
+logger = logging.getLogger(__name__)
+
+# same limit as the kernel
+MAX_SYMLINKS = 40
+COPY_CHUNK = 1 << 30
+_DIR_FLAGS = os.O_PATH | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+
+
+def open_root(pid):
+    """
+    Open the root directory of a process, as seen from its own mount
+    namespace
+    """
+    return os.open("/proc/{}/root".format(pid), os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+
+
+def root_accessible(pid):
+    """
+    Return true if the root of pid can be opened from here
+    """
+    try:
+        os.close(open_root(pid))
+        return True
+    except OSError:
+        return False
+
+
+def _split(path):
+    return [x for x in path.split("/") if x and x != "."]
+
+
+def resolve(root_fd, path, makedirs=False, owner=None):
+    """
+    Resolve path below root_fd the way a chroot would: '..' never leaves
+    the root and absolute symlinks start over at the root, so no link can
+    point outside of the container. Missing directories are created with
+    makedirs, owned by owner (uid, gid) if given.
+
+    Returns (directory fd, name) of the last component, which is not a
+    symlink. The caller closes the fd. name is "." for the root itself.
+    """
+    parts = _split(path)
+    stack = [os.dup(root_fd)]
+    links = 0
+    try:
+        while parts:
+            name = parts.pop(0)
+            if name == "..":
+                if len(stack) > 1:
+                    os.close(stack.pop())
+                continue
+            try:
+                st = os.stat(name, dir_fd=stack[-1], follow_symlinks=False)
+            except FileNotFoundError:
+                if not parts:
+                    return stack.pop(), name
+                if not makedirs:
+                    raise
+                os.mkdir(name, 0o755, dir_fd=stack[-1])
+                if owner is not None:
+                    os.chown(name, *owner, dir_fd=stack[-1], follow_symlinks=False)
+                st = os.stat(name, dir_fd=stack[-1], follow_symlinks=False)
+            if stat.S_ISLNK(st.st_mode):
+                links += 1
+                if links > MAX_SYMLINKS:
+                    raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+                target = os.readlink(name, dir_fd=stack[-1])
+                if target.startswith("/"):
+                    while len(stack) > 1:
+                        os.close(stack.pop())
+                parts = _split(target) + parts
+                continue
+            if not parts:
+                return stack.pop(), name
+            if not stat.S_ISDIR(st.st_mode):
+                raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+            # O_NOFOLLOW: fails if the entry was swapped for a link meanwhile
+            stack.append(os.open(name, _DIR_FLAGS, dir_fd=stack[-1]))
+        return stack.pop(), "."
+    finally:
+        for fd in stack:
+            os.close(fd)
+
+
+def lstat(dir_fd, name):
+    """
+    os.stat of an entry without following it, None if it does not exist
+    """
+    try:
+        return os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        return None
+
+
+def exists(root_fd, path):
+    """
+    Return true if path exists below root_fd, resolved like resolve()
+    """
+    try:
+        dir_fd, name = resolve(root_fd, path)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    try:
+        return lstat(dir_fd, name) is not None
+    finally:
+        os.close(dir_fd)
+
+
+def open_dir(dir_fd, name):
+    """
+    Open a resolved directory entry for use as dir_fd
+    """
+    return os.open(name, _DIR_FLAGS, dir_fd=dir_fd)
+
+
+def map_id(pid, host_id, kind="uid"):
+    """
+    Translate an id as seen inside the container of pid to the host id,
+    for containers running in a user namespace
+    """
+    try:
+        with open("/proc/{}/{}_map".format(pid, kind), "r") as f:
+            for line in f:
+                inside, outside, count = (int(x) for x in line.split())
+                if inside <= host_id < inside + count:
+                    return outside + host_id - inside
+    except (OSError, ValueError):
+        pass
+    return host_id
+
+
+def owner_of(pid, st):
+    """
+    Host (uid, gid) for a file that should have the owner of st inside
+    the container of pid
+    """
+    return map_id(pid, st.st_uid, "uid"), map_id(pid, st.st_gid, "gid")
+
+
+def copy_data(src_fd, dst_fd):
+    """
+    Copy a whole file in the kernel: copy_file_range, then sendfile, then
+    plain reads and writes. Returns the number of bytes copied.
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while True:
+                n = os.copy_file_range(src_fd, dst_fd, COPY_CHUNK)
+                if not n:
+                    return copied
+                copied += n
+        except OSError as exc:
+            # cross device on old kernels, special file systems
+            if copied or exc.errno not in (
+                errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP
+            ):
+                raise
+    try:
+        while True:
+            n = os.sendfile(dst_fd, src_fd, None, COPY_CHUNK)
+            if not n:
+                return copied
+            copied += n
+    except OSError as exc:
+        if copied or exc.errno not in (errno.EINVAL, errno.ENOSYS):
+            raise
+    while True:
+        buf = os.read(src_fd, 1 << 20)
+        if not buf:
+            return copied
+        view = memoryview(buf)
+        while view:
+            n = os.write(dst_fd, view)
+            view = view[n:]
+        copied += len(buf)
+
+
+def copy_file(src_fd, st, dir_fd, name, owner=None):
+    """
+    Copy an open regular file to name in dir_fd through a temporary file
+    renamed into place, keeping mode, times and (mapped) ownership.
+    Returns the number of bytes copied.
+    """
+    tmp = ".{}.nspctl-{}".format(name, uuid.uuid4().hex[:8])
+    dst_fd = os.open(
+        tmp,
+        os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC,
+        0o600,
+        dir_fd=dir_fd,
+    )
+    try:
+        try:
+            copied = copy_data(src_fd, dst_fd)
+            if owner is not None:
+                os.fchown(dst_fd, *owner)
+            os.fchmod(dst_fd, stat.S_IMODE(st.st_mode))
+            os.utime(dst_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(dst_fd)
+        os.rename(tmp, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    except BaseException:
+        try:
+            os.unlink(tmp, dir_fd=dir_fd)
+        except OSError:
+            pass
+        raise
+    return copied
+
+
+def copy_in(pid, source, dest, overwrite=False, makedirs=False):
+    """
+    Copy a host file into the container of pid through /proc/<pid>/root,
+    without entering its namespaces. dest follows the cp rules: an
+    existing directory receives the file under its own name.
+    """
+    source_name = os.path.basename(source)
+    root_owner = map_id(pid, 0, "uid"), map_id(pid, 0, "gid")
+    root = open_root(pid)
+    try:
+        try:
+            dir_fd, name = resolve(root, dest, makedirs=makedirs, owner=root_owner)
+        except FileNotFoundError:
+            raise Exception("Directory does not exist in container")
+        except NotADirectoryError:
+            raise Exception("Destination path {} is not a directory".format(dest))
+    finally:
+        os.close(root)
+
+    try:
+        st = lstat(dir_fd, name)
+        if st is not None and stat.S_ISDIR(st.st_mode):
+            sub_fd = open_dir(dir_fd, name)
+            os.close(dir_fd)
+            dir_fd, name = sub_fd, source_name
+            dest = os.path.join(dest, source_name)
+            st = lstat(dir_fd, name)
+        if st is not None:
+            if not overwrite:
+                raise Exception(
+                    "Destination path {} already exists. Use overwrite=True to "
+                    "overwrite it".format(dest)
+                )
+            if stat.S_ISDIR(st.st_mode):
+                raise Exception("Destination path {} is a directory".format(dest))
+
+        with open(source, "rb") as f:
+            src_st = os.fstat(f.fileno())
+            copy_file(f.fileno(), src_st, dir_fd, name, owner=owner_of(pid, src_st))
+    except OSError as exc:
+        raise Exception("Failed copying the file: {}".format(exc))
+    finally:
+        os.close(dir_fd)
+    return "Copy command completed!"
+
+
+def open_source(pid, path):
+    """
+    Resolve an existing path in the container of pid. Returns (directory
+    fd, name, stat); the caller closes the fd.
+    """
+    root = open_root(pid)
+    try:
+        dir_fd, name = resolve(root, path)
+    finally:
+        os.close(root)
+    st = lstat(dir_fd, name)
+    if st is None:
+        os.close(dir_fd)
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    return dir_fd, name, st
+
+
+def entries(dir_fd, name, st):
+    """
+    Yield (relative path, stat, directory fd, name) for an entry and, if
+    it is a directory, everything below it, parents first. The walk goes
+    by file descriptors and never follows symlinks.
+    """
+    yield ".", st, dir_fd, name
+    if not stat.S_ISDIR(st.st_mode):
+        return
+    top = open_dir(dir_fd, name)
+    try:
+        for path, dirs, files, fd in os.fwalk(".", dir_fd=top, follow_symlinks=False):
+            for entry in dirs + files:
+                entry_st = lstat(fd, entry)
+                if entry_st is not None:
+                    yield os.path.normpath(os.path.join(path, entry)), entry_st, fd, entry
+    finally:
+        os.close(top)
+
+
+def _open_file(dir_fd, name):
+    return os.open(name, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd)
+
+
+def extract_to(items, target, progress=None):
+    """
+    Recreate the entries yielded by entries() at the host path target,
+    keeping modes, owners and times. Returns (files, bytes copied).
+    """
+    files = size = 0
+    dirs = []
+    started = time.monotonic()
+    for rel, st, dir_fd, name in items:
+        path = os.path.normpath(os.path.join(target, rel))
+        if stat.S_ISDIR(st.st_mode):
+            if not os.path.isdir(path):
+                os.mkdir(path, 0o700)
+            # metadata last, creating entries changes the mtime
+            dirs.append((path, st))
+        elif stat.S_ISREG(st.st_mode):
+            src_fd = _open_file(dir_fd, name)
+            parent = os.open(os.path.dirname(path), os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+            try:
+                size += copy_file(src_fd, st, parent, os.path.basename(path),
+                                  owner=(st.st_uid, st.st_gid))
+            finally:
+                os.close(parent)
+                os.close(src_fd)
+        elif stat.S_ISLNK(st.st_mode):
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(os.readlink(name, dir_fd=dir_fd), path)
+            os.lchown(path, st.st_uid, st.st_gid)
+        else:
+            logger.warning("Skipping special file %s", path)
+            continue
+        files += 1
+        if progress is not None:
+            progress(size, None, time.monotonic() - started)
+    for path, st in reversed(dirs):
+        os.chown(path, st.st_uid, st.st_gid)
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return files, size
+
+
+def archive_to(items, target, arcname, compress, progress=None):
+    """
+    Write the entries yielded by entries() to a compressed tar archive at
+    the host path target, under arcname. Returns (files, bytes archived).
+    """
+    files = size = 0
+    started = time.monotonic()
+    with tarfile.open(target, "w:{}".format(compress), format=tarfile.PAX_FORMAT) as tar:
+        for rel, st, dir_fd, name in items:
+            info = tarfile.TarInfo(os.path.normpath(os.path.join(arcname, rel)))
+            info.mode = stat.S_IMODE(st.st_mode)
+            info.uid, info.gid = st.st_uid, st.st_gid
+            info.mtime = st.st_mtime
+            if stat.S_ISDIR(st.st_mode):
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif stat.S_ISREG(st.st_mode):
+                info.size = st.st_size
+                with os.fdopen(_open_file(dir_fd, name), "rb") as f:
+                    tar.addfile(info, f)
+                size += st.st_size
+            elif stat.S_ISLNK(st.st_mode):
+                info.type = tarfile.SYMTYPE
+                info.linkname = os.readlink(name, dir_fd=dir_fd)
+                tar.addfile(info)
+            else:
+                logger.warning("Skipping special file %s", info.name)
+                continue
+            files += 1
+            if progress is not None:
+                progress(size, None, time.monotonic() - started)
+    return files, size
+
+
+def copy_out(pid, source, target, compress=None, progress=None):
+    """
+    Copy a file or directory tree out of the container of pid through
+    /proc/<pid>/root to the host path target. With compress ("gz", "bz2"
+    or "xz") target is a compressed tar archive. Returns (files, bytes).
+    """
+    dir_fd, name, st = open_source(pid, source)
+    try:
+        items = entries(dir_fd, name, st)
+        if compress:
+            arcname = os.path.basename(source.rstrip("/"))
+            return archive_to(items, target, arcname, compress, progress=progress)
+        return extract_to(items, target, progress=progress)
+    finally:
+        os.close(dir_fd)
+
+
+def _open_rel(top_fd, rel):
+    """
+    Open a directory below top_fd that we created, following no links
+    """
+    fd = os.dup(top_fd)
+    for part in _split(rel):
+        try:
+            sub = open_dir(fd, part)
+        finally:
+            os.close(fd)
+        fd = sub
+    return fd
+
+
+def remove(dir_fd, name):
+    """
+    Remove an entry, directories with everything below them
+    """
+    st = lstat(dir_fd, name)
+    if st is None:
+        return
+    if not stat.S_ISDIR(st.st_mode):
+        os.unlink(name, dir_fd=dir_fd)
+        return
+    top = open_dir(dir_fd, name)
+    try:
+        for _, dirs, files, fd in os.fwalk(".", dir_fd=top, topdown=False,
+                                            follow_symlinks=False):
+            for entry in files:
+                os.unlink(entry, dir_fd=fd)
+            for entry in dirs:
+                # links to directories are listed as directories
+                entry_st = lstat(fd, entry)
+                if entry_st is not None and stat.S_ISLNK(entry_st.st_mode):
+                    os.unlink(entry, dir_fd=fd)
+                else:
+                    os.rmdir(entry, dir_fd=fd)
+    finally:
+        os.close(top)
+    os.rmdir(name, dir_fd=dir_fd)
+
+
+def _same_file(path, st, dir_fd, name, old, checksum=None):
+    """
+    Compare a host file with the container file it would replace: by
+    size and mtime, or by size and content hash
+    """
+    if not stat.S_ISREG(old.st_mode) or old.st_size != st.st_size:
+        return False
+    if checksum is None:
+        return old.st_mtime_ns == st.st_mtime_ns
+    hashfunc = hashfunc_map[checksum]
+    fd = _open_file(dir_fd, name)
+    try:
+        # the container may truncate it any time, so it is not mapped
+        theirs = hashfunc.checksum_file("/proc/self/fd/{}".format(fd), use_mmap=False)[0]
+    finally:
+        os.close(fd)
+    return theirs == hashfunc.checksum_file(path)[0]
+
+
+def _set_meta(dir_fd, name, st, owner):
+    """
+    Apply owner, mode and times of st to an existing directory or file
+    """
+    fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd)
+    try:
+        os.fchown(fd, *owner)
+        os.fchmod(fd, stat.S_IMODE(st.st_mode))
+        os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+    finally:
+        os.close(fd)
+
+
+def sync_in(pid, source, dest, checksum=None, delete=False, progress=None):
+    """
+    Make the dest directory in the container of pid a copy of the host
+    directory source, transferring only new and changed files. Files are
+    compared by size and mtime, or by size and the checksum named (one of
+    utils.checksum.hashfunc_map). With delete, entries missing on the host
+    are removed. Returns a dict of counters.
+    """
+    stats = {
+        "transferred": 0,
+        "transferred_bytes": 0,
+        "unchanged": 0,
+        "saved_bytes": 0,
+        "deleted": 0,
+    }
+    root_owner = map_id(pid, 0, "uid"), map_id(pid, 0, "gid")
+    root = open_root(pid)
+    try:
+        dir_fd, name = resolve(root, dest, makedirs=True, owner=root_owner)
+    finally:
+        os.close(root)
+    try:
+        if lstat(dir_fd, name) is None:
+            os.mkdir(name, 0o755, dir_fd=dir_fd)
+            os.chown(name, *root_owner, dir_fd=dir_fd, follow_symlinks=False)
+        top = open_dir(dir_fd, name)
+    finally:
+        os.close(dir_fd)
+
+    started = time.monotonic()
+    try:
+        existing = {
+            rel: st for rel, st, _, _ in entries(top, ".", lstat(top, ".")) if rel != "."
+        }
+        seen = set()
+        dirs = []
+        for path, dirnames, filenames in os.walk(source):
+            rel_dir = os.path.relpath(path, source)
+            cdir = _open_rel(top, rel_dir)
+            try:
+                for entry in sorted(dirnames + filenames):
+                    rel = os.path.normpath(os.path.join(rel_dir, entry))
+                    host = os.path.join(path, entry)
+                    st = os.lstat(host)
+                    owner = owner_of(pid, st)
+                    old = existing.get(rel)
+                    seen.add(rel)
+                    if old is not None and (
+                        stat.S_IFMT(old.st_mode) != stat.S_IFMT(st.st_mode)
+                    ):
+                        remove(cdir, entry)
+                        if stat.S_ISDIR(old.st_mode):
+                            # its entries went with it, nothing left to delete
+                            for key in [x for x in existing if x.startswith(rel + "/")]:
+                                del existing[key]
+                        old = None
+
+                    if stat.S_ISDIR(st.st_mode):
+                        if old is None:
+                            os.mkdir(entry, 0o700, dir_fd=cdir)
+                        dirs.append((rel_dir, entry, st, owner))
+                    elif stat.S_ISREG(st.st_mode):
+                        if old is not None and _same_file(host, st, cdir, entry, old, checksum):
+                            stats["unchanged"] += 1
+                            stats["saved_bytes"] += st.st_size
+                            if old.st_mtime_ns != st.st_mtime_ns:
+                                _set_meta(cdir, entry, st, owner)
+                            continue
+                        with open(host, "rb") as f:
+                            stats["transferred_bytes"] += copy_file(
+                                f.fileno(), st, cdir, entry, owner=owner
+                            )
+                        stats["transferred"] += 1
+                    elif stat.S_ISLNK(st.st_mode):
+                        target = os.readlink(host)
+                        if old is not None and os.readlink(entry, dir_fd=cdir) == target:
+                            stats["unchanged"] += 1
+                            continue
+                        if old is not None:
+                            os.unlink(entry, dir_fd=cdir)
+                        os.symlink(target, entry, dir_fd=cdir)
+                        os.chown(entry, *owner, dir_fd=cdir, follow_symlinks=False)
+                        stats["transferred"] += 1
+                    else:
+                        logger.warning("Skipping special file %s", host)
+                        continue
+                    if progress is not None:
+                        progress(stats["transferred_bytes"], None,
+                                 time.monotonic() - started)
+            finally:
+                os.close(cdir)
+
+        if delete:
+            gone = set()
+            for rel in sorted(set(existing) - seen):
+                # sorted, so a removed directory comes before its entries
+                if any(rel.startswith(x + "/") for x in gone):
+                    continue
+                cdir = _open_rel(top, os.path.dirname(rel))
+                try:
+                    remove(cdir, os.path.basename(rel))
+                finally:
+                    os.close(cdir)
+                gone.add(rel)
+                stats["deleted"] += 1
+
+        # directory metadata last, creating entries changes the mtime
+        for rel_dir, entry, st, owner in reversed(dirs):
+            cdir = _open_rel(top, rel_dir)
+            try:
+                _set_meta(cdir, entry, st, owner)
+            finally:
+                os.close(cdir)
+    finally:
+        os.close(top)
+    stats["time"] = "{:.2f}s".format(time.monotonic() - started)
+    return stats
@@ -1,5 +1,8 @@
 import logging
+import os
+import stat
 import tarfile
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -13,3 +16,65 @@ def tar_extract(filename, dest):
             return True
     except (OSError, tarfile.TarError):
         return False
+
+
+class ByteCounter:
+    """
+    File object wrapper counting the bytes going through it
+    """
+
+    def __init__(self, fileobj, progress=None, total=None):
+        self.fileobj = fileobj
+        self.progress = progress
+        self.total = total
+        self.bytes = 0
+        self.started = time.monotonic()
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.bytes += len(data)
+        if self.progress is not None:
+            self.progress(self.bytes, self.total, time.monotonic() - self.started)
+        return len(data)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes += len(data)
+        if self.progress is not None:
+            self.progress(self.bytes, self.total, time.monotonic() - self.started)
+        return data
+
+
+def tree_size(sources):
+    """
+    Return (number of files, bytes of regular files) below the sources
+    """
+    files = size = 0
+    for source in sources:
+        paths = [source]
+        if os.path.isdir(source) and not os.path.islink(source):
+            paths = (os.path.join(root, x) for root, _, names in os.walk(source) for x in names)
+        for path in paths:
+            st = os.lstat(path)
+            files += 1
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+    return files, size
+
+
+def tar_stream(sources, fileobj, progress=None, total=None):
+    """
+    Write files and directory trees to fileobj as one tar stream, each
+    source under its base name, keeping owners, modes and times.
+    progress(done, total, elapsed) is called as the archive is written,
+    total is the tree_size() bytes if the caller already has them.
+    Returns the number of archive bytes written.
+    """
+    if total is None and progress is not None:
+        total = tree_size(sources)[1]
+    out = ByteCounter(fileobj, progress, total)
+    with tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT,
+                      bufsize=1 << 20) as tar:
+        for source in sources:
+            tar.add(source, arcname=os.path.basename(source.rstrip("/")))
+    return out.bytes